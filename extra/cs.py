@@ -22,12 +22,17 @@ Note that the configuration may compile C# snippets::
 			bintype='exe', csflags=['-pkg:gtk-sharp-2.0'], msg='Checking for Gtksharp support')
 """
 
-import os, shutil, tempfile
+import errno, json, os, re, shutil, sys, tempfile, time, zipfile
 
-from waflib import Context, Errors, Logs, Options, Task, Utils, Node
-from waflib.Configure import conf
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+from waflib import Build, Context, Errors, Logs, Options, Runner, Task, TaskGen, Utils, Node
+from waflib.Configure import conf, ConfigurationContext
 from waflib.TaskGen import after, before, extension, feature
-from waflib.Tools import ccroot
+from waflib.Tools import ccroot, c_config
 
 ccroot.USELIB_VARS['cs'] = set(['CSFLAGS', 'ASSEMBLIES', 'RESOURCES'])
 ccroot.lib_patterns['csshlib'] = ['%s']
@@ -65,44 +70,219 @@ def apply_cs(self):
 
 @feature('cs')
 @after('apply_cs')
-def use_cs(self):
+@before('use_cs')
+def refout_cs(self):
 	"""
-	C# applications honor the **use** keyword::
+	Libraries may also emit a reference assembly (public surface only)::
 
 		def build(bld):
-			bld(features='cs', source='My.cs', bintype='library', gen='my.dll', name='mylib')
-			bld(features='cs', source='Hi.cs', includes='.', bintype='exe', target='hi.exe', use='mylib', name='hi')
+			bld(features='cs', source='My.cs', bintype='library', target='my.dll', refout=True)
+			# refout defaults to the configuration variable CS_REFOUT
+
+	The dependent assemblies are keyed on the hash of the reference assembly instead
+	of the signature of the library, so a change in a method body only recompiles
+	the library itself.
+	"""
+	if not getattr(self, 'refout', self.env.CS_REFOUT):
+		return
+
+	tsk = self.cs_task
+	if tsk.env.CSTYPE != '/target:library':
+		return
+
+	node = tsk.outputs[0]
+	tsk.ref_node = node.parent.find_or_declare(['ref', node.name])
+	self.env.append_value('CSFLAGS', '/refout:%s' % tsk.ref_node.abspath())
+
+@feature('cs')
+@after('apply_cs')
+@before('use_cs', 'apply_cs_modules')
+def deterministic_cs(self):
+	"""
+	The same sources may always give the same assemblies, byte for byte::
+
+		def build(bld):
+			bld(features='cs', source='My.cs', bintype='library', target='my.dll', deterministic=True)
+			# deterministic defaults to the configuration variable CS_DETERMINISTIC
+
+	The compiler is asked for a deterministic output (no MVID or timestamp from the clock)
+	and the build and source directories are mapped to fixed paths in the debug information,
+	when it supports it, see :py:func:`check_cs_deterministic`. The flags are put in a
+	fixed order by :py:func:`normalize_cs_flags` and the outputs are signed by their contents,
+	so the dependent assemblies are not compiled again when a library is rebuilt identically.
+	"""
+	if not getattr(self, 'deterministic', self.env.CS_DETERMINISTIC):
+		return
+
+	self.env.CS_DETERMINISTIC = True
+	self.env.append_value('CSFLAGS', self.env.CS_DETERMINISTIC_FLAGS)
+	if self.env.CS_PATHMAP:
+		paths = [(self.bld.bldnode, '/_bld/'), (self.bld.srcnode, '/_/')]
+		self.env.append_value('CSFLAGS', '/pathmap:%s' % ','.join('%s%s=%s' % (x.abspath(), os.sep, y) for (x, y) in paths))
+
+class cs_reference(object):
+	"""
+	C# reference resolved from the *use* attribute by :py:func:`cs_references`. The *kind* is one of:
+
+	* 'project': C# task generator (*tg*, *task* and *node* are set)
+	* 'assembly': foreign assembly, from check_assembly (*flags*) or read_csshlib (*tg*, *task*)
+	* 'package': pkg-config package registered by check_pkg (*package* and *flags*)
+	* 'framework': anything else, handed to the compiler as is
+	"""
+	def __init__(self, kind, name, tg=None, task=None, node=None, flags=[], package=None):
+		self.kind = kind
+		self.name = name
+		self.tg = tg
+		self.task = task
+		self.node = node
+		self.flags = flags
+		self.package = package
+
+	def __repr__(self):
+		return '<cs_reference %s %r>' % (self.kind, self.name)
+
+@TaskGen.taskgen_method
+def cs_references(self, transitive=True):
 	"""
-	names = self.to_list(getattr(self, 'use', []))
+	Resolve the **use** attribute of a task generator into a list of :py:class:`cs_reference`.
+	The references of the C# projects used are followed, so that only the direct
+	references need to be listed. The result is computed once per task generator
+	and kept on the build context.
+
+	:param transitive: return the references of the projects used too
+	:type transitive: bool
+	"""
+	try:
+		cache = self.bld.cs_references_cache
+	except AttributeError:
+		cache = self.bld.cs_references_cache = {}
+
+	try:
+		ret = cache[self]
+	except KeyError:
+		cache[self] = None
+		ret = cache[self] = self.resolve_cs_references()
+	if ret is None:
+		self.bld.fatal('Cycle detected in the use graph of %r' % self.name)
+	(direct, closure) = ret
+	return transitive and closure or direct
+
+@TaskGen.taskgen_method
+def resolve_cs_references(self):
+	direct = []
 	get = self.bld.get_tgen_by_name
-	for x in names:
+	for x in self.to_list(getattr(self, 'use', [])):
 		uselib = x.upper()
 
+		csflags = Utils.to_list(getattr(self.env, 'CSFLAGS_' + uselib, []))
 		pkg = getattr(self.env, 'PKG_' + uselib, [])
-		if len(pkg) and self.env.CS_NAME == "mono":
-			self.env.append_value('CSFLAGS', '/pkg:%s' % pkg)
+		if len(pkg):
+			direct.append(cs_reference('package', x, flags=csflags, package=pkg))
 			continue
 
-		csflags = getattr(self.env, 'CSFLAGS_' + uselib, [])
 		if len(csflags):
-			self.env.append_value('CSFLAGS', csflags);
+			node = self.bld.root.find_node(csflags[0][3:])
+			direct.append(cs_reference('assembly', x, node=node, flags=csflags))
 			continue
 
 		try:
 			y = get(x)
 		except Errors.WafError:
-			self.env.append_value('CSFLAGS', '/reference:%s' % x)
+			direct.append(cs_reference('framework', x))
 			continue
 		y.post()
 
 		tsk = getattr(y, 'cs_task', None) or getattr(y, 'link_task', None)
 		if not tsk:
 			self.bld.fatal('cs task has no link task for use %r' % self)
+		kind = getattr(y, 'cs_task', None) and 'project' or 'assembly'
+		direct.append(cs_reference(kind, x, tg=y, task=tsk, node=tsk.outputs[0]))
+
+	closure = []
+	seen = set()
+	for ref in direct:
+		lst = [ref]
+		if ref.kind == 'project':
+			lst.extend(ref.tg.cs_references())
+		for r in lst:
+			if not r.name in seen:
+				seen.add(r.name)
+				closure.append(r)
+	return (direct, closure)
+
+@feature('cs')
+@after('apply_cs')
+def use_cs(self):
+	"""
+	C# applications honor the **use** keyword::
+
+		def build(bld):
+			bld(features='cs', source='My.cs', bintype='library', gen='my.dll', name='mylib')
+			bld(features='cs', source='Hi.cs', includes='.', bintype='exe', target='hi.exe', use='mylib', name='hi')
+
+	The references of *mylib* are added to *hi* too, see :py:func:`cs_references`.
+	"""
+	for x in self.cs_references():
+		# the foreign assemblies are in the signature and in the cache key (see cache_key)
+		self.cs_task.dep_nodes.extend(reference_nodes(self.bld, x))
+
+		if x.kind == 'package' and self.env.CS_NAME == "mono":
+			self.env.append_value('CSFLAGS', '/pkg:%s' % x.package)
+			continue
+
+		if len(x.flags):
+			self.env.append_value('CSFLAGS', x.flags);
+			continue
+
+		if not x.task:
+			self.env.append_value('CSFLAGS', '/reference:%s' % x.name)
+			continue
 
-		self.cs_task.dep_nodes.extend(tsk.outputs) # dependency
+		tsk = x.task
+		ref = getattr(tsk, 'ref_node', None)
+		if ref:
+			self.cs_task.dep_nodes.append(ref) # dependency on the public surface only
+		else:
+			self.cs_task.dep_nodes.extend(tsk.outputs) # dependency
 		self.cs_task.set_run_after(tsk) # order (redundant, the order is infered from the nodes inputs/outputs)
 		self.env.append_value('CSFLAGS', '/reference:%s' % tsk.outputs[0].abspath())
 
+def reference_nodes(bld, ref):
+	"""
+	Foreign assemblies of a reference from check_assembly or check_pkg, which no task of the
+	build creates. They are signed by their contents, see :py:func:`h_assembly`.
+
+	:type ref: :py:class:`cs_reference`
+	:rtype: list of :py:class:`waflib.Node.Node`
+	"""
+	if ref.task:
+		return []
+	if ref.kind == 'package':
+		lst = [bld.root.find_node(x) for x in package_assemblies(ref)]
+	else:
+		lst = [ref.node]
+	ret = []
+	for x in lst:
+		if x:
+			x.sig = x.cache_sig = h_assembly(bld, x)
+			ret.append(x)
+	return ret
+
+# flags of the assemblies in the pkg-config output
+CS_REFERENCE_FLAGS = ('-r:', '/r:', '-reference:', '/reference:')
+
+def package_assemblies(ref):
+	"""
+	Paths of the assemblies of a pkg-config package, from its reference flags
+	"""
+	ret = []
+	for flag in Utils.to_list(ref.flags):
+		for y in CS_REFERENCE_FLAGS:
+			if flag.startswith(y):
+				ret.extend(flag[len(y):].split(','))
+				break
+	return ret
+
 @feature('cs')
 @after('apply_cs', 'use_cs')
 def debug_cs(self):
@@ -136,23 +316,526 @@ def debug_cs(self):
 		val = ['/debug-']
 	self.env.append_value('CSFLAGS', val)
 
+@feature('cs')
+@after('use_cs', 'debug_cs', 'propagate_uselib_vars')
+@before('copy_dependent_library')
+def apply_cs_modules(self):
+	"""
+	The sources of a large target may be split into netmodules which are compiled in parallel
+	and added to the assembly (/target:module and /addmodule)::
+
+		def build(bld):
+			bld(features='cs', source='Program.cs', target='Big.exe', cs_modules=[
+				{'name': 'Big.Model', 'source': bld.path.ant_glob('model/**/*.cs')},
+				{'name': 'Big.Data', 'source': bld.path.ant_glob('data/**/*.cs')},
+				{'name': 'Big.Views', 'source': bld.path.ant_glob('views/**/*.cs'), 'use': 'Big.Model'},
+			])
+
+	A module may only use the modules listed before it, and the modules cannot use the
+	sources of the target. The result is still one assembly, made of several files: the
+	.netmodule files are installed and staged with the assembly.
+	"""
+	modules = getattr(self, 'cs_modules', None)
+	if not modules:
+		return
+
+	main = self.cs_task
+	flags = [x for x in self.env.CSFLAGS if not x.startswith('/refout:')]
+	csdebug = getattr(self, 'csdebug', self.env.CSDEBUG) in ('full', 'pdbonly')
+
+	tasks = {}
+	self.cs_module_tasks = []
+	for m in modules:
+		name = m['name']
+		node = main.outputs[0].parent.find_or_declare(name + '.netmodule')
+		tsk = self.create_task('mcs', self.to_nodes(m['source']), node)
+		tsk.env.CSTYPE = '/target:module'
+		tsk.env.OUT = '/out:%s' % node.abspath()
+		tsk.env.RESOURCES = []
+		tsk.env.CSFLAGS = list(flags)
+		if csdebug:
+			if self.env.CS_NAME == 'mono':
+				tsk.outputs.append(node.parent.find_or_declare(node.name + '.mdb'))
+			else:
+				tsk.outputs.append(node.change_ext('.pdb'))
+
+		# same references as the assembly
+		for x in self.cs_references():
+			if x.task:
+				tsk.dep_nodes.append(getattr(x.task, 'ref_node', None) or x.task.outputs[0])
+				tsk.set_run_after(x.task)
+			else:
+				tsk.dep_nodes.extend(reference_nodes(self.bld, x))
+
+		for x in Utils.to_list(m.get('use', [])):
+			try:
+				dep = tasks[x]
+			except KeyError:
+				self.bld.fatal('%r: the module %r must be listed before %r' % (self, x, name))
+			tsk.dep_nodes.append(dep.outputs[0])
+			tsk.set_run_after(dep)
+			tsk.env.append_value('CSFLAGS', '/addmodule:%s' % dep.outputs[0].abspath())
+
+		main.dep_nodes.append(node)
+		main.set_run_after(tsk)
+		self.env.append_value('CSFLAGS', '/addmodule:%s' % node.abspath())
+		try:
+			self.install_task.source.extend(tsk.outputs)
+		except AttributeError:
+			pass
+		tasks[name] = tsk
+		self.cs_module_tasks.append(tsk)
+
+@feature('cs')
+@after('apply_cs', 'propagate_uselib_vars', 'apply_resx')
+def apply_cs_resources(self):
+	"""
+	The embedded resources (attribute *resources*, see :py:func:`import_resources`, and the
+	.resources files of resx.py) are dependencies of the assembly::
+
+		def build(bld):
+			bld(features='cs', source='main.cs', target='app.exe', resource_assembly=True,
+				resources=bld.import_resources(bld.path.ant_glob('icons/*.png'), namespace='App.Icons'))
+
+	With *resource_assembly* (True for app.Resources.dll, or a file name) the resources are
+	linked by al into a separate library, so that a change in a resource does not compile
+	the code again; the application loads them from that assembly. With *resource_culture*,
+	it is the satellite assembly of the culture instead (fr/app.resources.dll).
+	"""
+	tsk = self.cs_task
+	lst = []
+	nodes = []
+	for x in Utils.to_list(tsk.env.RESOURCES):
+		(path, sep, link) = x.partition(',')
+		node = resource_node(self, path)
+		if not node:
+			self.bld.fatal('%r: could not find the resource %r' % (self, path))
+		lst.append(node.abspath() + sep + link)
+		nodes.append(node)
+
+	name = getattr(self, 'resource_assembly', None)
+	culture = getattr(self, 'resource_culture', None)
+	if not nodes or not (name or culture):
+		tsk.env.RESOURCES = lst
+		for x in nodes:
+			if not x in tsk.dep_nodes:
+				tsk.dep_nodes.append(x) # dependency
+		return
+
+	if not self.env.AL:
+		self.bld.fatal('%r: al is required for the resource assemblies' % self)
+
+	main = tsk.outputs[0]
+	base = os.path.splitext(main.name)[0]
+	if culture:
+		out = main.parent.find_or_declare([culture, base + '.resources.dll'])
+	else:
+		out = main.parent.find_or_declare(name is True and base + '.Resources.dll' or name)
+
+	tsk.env.RESOURCES = []
+	tsk.dep_nodes = [x for x in tsk.dep_nodes if not x in nodes]
+	self.cs_resource_task = res = self.create_task('al', nodes, out)
+	res.env.RESOURCES = lst
+	if culture:
+		# the satellite assembly takes the name and the version of the assembly
+		res.env.ALFLAGS = ['/culture:%s' % culture, '/template:%s' % main.abspath()]
+		res.dep_nodes.append(main)
+
+	inst = getattr(self, 'install_task', None)
+	if inst:
+		if culture:
+			self.bld.install_files(os.path.join(inst.dest, culture), out, env=self.env)
+		else:
+			inst.source.append(out)
+
+def resource_node(tgen, path):
+	"""
+	Node of an embedded resource. The files produced by the build (resx.py) may not exist
+	yet, their declared nodes are searched without looking at the file system: find_node
+	would remove them.
+	"""
+	bld = tgen.bld
+	if os.path.isabs(path):
+		node = bld.root.search_node(path)
+		if node and node.is_child_of(bld.bldnode):
+			return node
+		return bld.root.find_node(path)
+	# relative to the build directory (mcs runs there), or to the task generator
+	return bld.bldnode.search_node(path) or tgen.path.find_resource(path)
+
+# flags which may be given in any order (not /lib:, the folders are searched in order)
+CS_UNORDERED_FLAGS = ('/reference:', '/r:', '-r:', '/pkg:', '-pkg:', '/define:', '/d:', '-d:', '/addmodule:', '/nowarn:')
+
+@feature('cs')
+@after('use_cs', 'debug_cs', 'apply_cs_modules', 'propagate_uselib_vars')
+def normalize_cs_flags(self):
+	"""
+	In deterministic mode (see :py:func:`deterministic_cs`), remove the duplicate flags and sort
+	the references, defines and modules so the command line (and the task signature) does not
+	depend on the order of the *use* attribute or of the methods adding them. The other flags
+	keep their order.
+	"""
+	if not self.env.CS_DETERMINISTIC:
+		return
+
+	for tsk in [self.cs_task] + getattr(self, 'cs_module_tasks', []):
+		tsk.env.CSFLAGS = normalize_flags(tsk.env.CSFLAGS)
+
+def normalize_flags(flags):
+	seen = set()
+	lst = []
+	unordered = []
+	for x in Utils.to_list(flags):
+		if x in seen:
+			continue
+		seen.add(x)
+		if x.lower().startswith(CS_UNORDERED_FLAGS):
+			unordered.append(x)
+		else:
+			lst.append(x)
+	return lst + sorted(unordered)
+
+@feature('cs_aot')
+@after('apply_cs', 'debug_cs', 'apply_cs_modules')
+def apply_cs_aot(self):
+	"""
+	Precompile the assembly and the foreign assemblies it uses (check_assembly, read_assembly)
+	to native code, so that they are not compiled by the JIT at startup::
+
+		def build(bld):
+			bld(features='cs cs_aot', source='main.cs', target='app.exe', use='Eto', aot=['full'])
+			# aot is the list of the mono --aot options, CS_AOT by default (configure --cs-aot-full)
+
+	The images (app.exe.so) are installed next to the assemblies, mono loads them instead of
+	compiling the methods when the assembly did not change. They are keyed on the contents
+	of the assemblies (see :py:class:`cs_aot`), a foreign assembly is precompiled once per build,
+	and only when it is installed (read_assembly with an *install_path*).
+	"""
+	if not self.env.MONO:
+		self.bld.fatal('%r: cs_aot requires mono (configure: conf.load(\'cs\') on a platform with mono)' % self)
+
+	refs = [x.node for x in self.cs_references() if x.node]
+	# a foreign assembly may only reference foreign assemblies
+	externals = [x.node for x in self.cs_references() if x.kind == 'assembly' and x.node]
+	try:
+		tasks = self.bld.cs_aot_tasks
+	except AttributeError:
+		tasks = self.bld.cs_aot_tasks = {}
+
+	main = self.cs_task.outputs[0]
+	inst = getattr(self, 'install_task', None)
+	lst = [(main, main.parent.find_or_declare(main.name + self.env.CS_AOT_EXT), refs,
+		inst and [inst.dest] or [], self.env)]
+	if getattr(self, 'aot_externals', True):
+		installed = getattr(self.bld, 'cs_assembly_dests', {})
+		for node in externals:
+			# the image is only loaded from the folder of the assembly (read_assembly, install_path)
+			if not node in installed:
+				continue
+			# one folder per source folder, the assemblies of different folders may have the same name
+			folder = Utils.to_hex(Utils.md5(node.parent.abspath().encode()).digest())[:16]
+			out = self.bld.bldnode.find_or_declare(['aot', folder, node.name + self.env.CS_AOT_EXT])
+			lst.append((node, out, [x for x in externals if not x is node], installed[node], self.bld.env))
+
+	for (node, out, deps, dests, env) in lst:
+		try:
+			tsk = tasks[node]
+		except KeyError:
+			tsk = tasks[node] = self.create_task('cs_aot', node, out)
+			tsk.env.CS_AOT = Utils.to_list(getattr(self, 'aot', self.env.CS_AOT))
+			tsk.dep_nodes.extend(deps)
+			tsk.mono_path = sorted(set(x.parent.abspath() for x in deps))
+		for dest in dests:
+			install_aot(self.bld, tsk.outputs[0], dest, env)
+
+def install_aot(bld, node, dest, env):
+	"""
+	Install an image in a folder of its assembly, once per folder
+	"""
+	try:
+		seen = bld.cs_aot_installed
+	except AttributeError:
+		seen = bld.cs_aot_installed = set()
+	key = (Utils.subst_vars(dest, env), node)
+	if not key in seen:
+		seen.add(key)
+		bld.install_files(dest, node, env=env)
+
+@feature('cs')
+@after('apply_cs', 'use_cs', 'apply_cs_modules')
+def apply_cs_bundle(self):
+	"""
+	With *waf configure --package-dep*, the programs are packed with the assemblies they
+	use (the C# projects and the foreign assemblies of the use closure) into one file::
+
+		def build(bld):
+			bld(features='cs', source='main.cs', target='app.exe', use='Eto gtk-sharp-2.0',
+				package_dep=True, bundle_packages=True)
+
+	The package is a program made by mkbundle, or a zip archive of the assemblies and their
+	.config files (CS_BUNDLE, configure --package-dep-format), compressed with
+	--package-dep-compress. The pkg-config packages are added with *bundle_packages*
+	(configure --package-dep-pkg). The package is made again only when the contents
+	of an assembly change, and it is installed next to the program.
+	"""
+	if not getattr(self, 'package_dep', self.env.package_dep_lib):
+		return
+	tsk = self.cs_task
+	if not tsk.env.CSTYPE in ('/target:exe', '/target:winexe'):
+		return
+
+	main = tsk.outputs[0]
+	# the netmodules of the multi-file assemblies, see apply_cs_modules
+	nodes = [main] + [t.outputs[0] for t in getattr(self, 'cs_module_tasks', [])]
+	for x in self.cs_references():
+		if x.node:
+			nodes.append(x.node)
+			nodes.extend(t.outputs[0] for t in getattr(x.tg, 'cs_module_tasks', []))
+		elif x.kind == 'package' and getattr(self, 'bundle_packages', self.env.CS_BUNDLE_PKG):
+			for path in package_assemblies(x):
+				node = self.bld.root.find_node(path)
+				if not node:
+					self.bld.fatal('%r: could not find the assembly %r of the package %r' % (self, path, x.name))
+				nodes.append(node)
+
+	lst = []
+	for x in nodes:
+		if not x in lst:
+			lst.append(x)
+
+	base = os.path.splitext(main.name)[0]
+	if self.env.CS_BUNDLE == 'zip':
+		out = main.parent.find_or_declare(base + '.zip')
+		for x in lst[:]:
+			config = x.parent.find_node(x.name + '.config')
+			if config:
+				lst.append(config)
+	else:
+		if not self.env.MKBUNDLE:
+			self.bld.fatal('%r: mkbundle is required for --package-dep (or use --package-dep-format=zip)' % self)
+		out = main.parent.find_or_declare(base + (Utils.is_win32 and '.bundle.exe' or ''))
+	self.cs_bundle_task = self.create_task('cs_bundle', lst, out)
+
+	try:
+		self.install_task.source.append(out)
+	except AttributeError:
+		pass
+
 
 @extension('.cs.in')
 def process_in(self, node):
 	"""
 	Converts the *.cs.in source files into *.cs files replacing all @var@ with
-	the appropriate values in the related variable in the ctx.Define array
+	the appropriate values in the related variable in the ctx.Define array,
+	see :py:class:`subst_cs`
 	"""
 
 	tgt = node.change_ext('.cs', ext_in='.cs.in')
-	tsk = self.create_task('subst', node, tgt)
+	tsk = self.create_task('subst_cs', node, tgt)
 
+	tsk.defines = {}
 	for x in self.env['DEFINES']:
-		(k, v) = x.split('=')
-		setattr(tsk.generator, k, v)
+		(k, v) = (x.split('=', 1) + [''])[:2]
+		tsk.defines[k] = v
 
 	self.source.append(tgt)
 
+re_subst = re.compile('@(\w+)@', re.M)
+
+class subst_cs(Task.Task):
+	"""
+	Replace the @var@ tokens of a .cs.in file by the defines, the attributes of the task
+	generator or the configuration variables. The signature only depends on the variables
+	the template uses, and the .cs file is only written when its content changes.
+	"""
+	color = 'BLUE'
+
+	def template(self):
+		return self.inputs[0].read(encoding=getattr(self.generator, 'encoding', 'ISO8859-1'))
+
+	def tokens(self):
+		try:
+			return self.cs_tokens
+		except AttributeError:
+			self.cs_tokens = sorted(set(re_subst.findall(self.template())))
+			return self.cs_tokens
+
+	def value(self, name):
+		try:
+			return self.defines[name]
+		except (AttributeError, KeyError):
+			return str(getattr(self.generator, name, '') or self.env.get_flat(name) or self.env.get_flat(name.upper()))
+
+	def sig_vars(self):
+		self.m.update(Utils.h_list([(x, self.value(x)) for x in self.tokens()]))
+		return Task.Task.sig_vars(self)
+
+	def run(self):
+		encoding = getattr(self.generator, 'encoding', 'ISO8859-1')
+		code = re_subst.sub(lambda m: self.value(m.group(1)), self.template())
+
+		node = self.outputs[0]
+		try:
+			if node.read(encoding=encoding) == code:
+				return 0
+		except (OSError, IOError):
+			pass
+		node.write(code, encoding=encoding)
+		return 0
+
+def profile_task(cls):
+	"""
+	Class decorator recording the profile of the tasks that run with *waf --cs-profile*: wall
+	time, processor time and peak memory of the processes, number and size of the inputs
+	(see :py:func:`store_profile`)
+	"""
+	run = cls.run
+	def run_profiled(self):
+		if not profile_enabled():
+			return run(self)
+		self.cs_rusage = None
+		t = time.time()
+		try:
+			return run(self)
+		finally:
+			# the outputs restored from the artifact cache keep the duration of the compilation
+			if not getattr(self, 'cs_cached', False):
+				record_profile(self, time.time() - t)
+	cls.run = run_profiled
+	if not 'exec_command' in cls.__dict__:
+		def exec_profiled(self, cmd, **kw):
+			return exec_rusage(self, cmd, **kw)
+		cls.exec_command = exec_profiled
+	return cls
+
+def exec_rusage(tsk, cmd, **kw):
+	"""
+	Run *cmd* like bld.exec_command, and keep the processor time and the peak memory of the
+	process on the task (os.wait4). The platforms without wait4, the commands redirecting
+	their outputs and the builds without *--cs-profile* are passed to bld.exec_command.
+	"""
+	bld = tsk.generator.bld
+	# same working directory as Task.exec_command
+	try:
+		if not kw.get('cwd', None):
+			kw['cwd'] = bld.cwd
+	except AttributeError:
+		bld.cwd = kw['cwd'] = bld.variant_dir
+
+	if not profile_enabled() or not hasattr(os, 'wait4') or not isinstance(cmd, list) or bld.logger or 'stdout' in kw or 'stderr' in kw:
+		return bld.exec_command(cmd, **kw)
+
+	Logs.debug('runner: %r' % cmd)
+	kw['shell'] = False
+	out = tempfile.TemporaryFile()
+	err = tempfile.TemporaryFile()
+	try:
+		try:
+			proc = Utils.subprocess.Popen(cmd, stdout=out, stderr=err, **kw)
+		except Exception as e:
+			raise Errors.WafError('Execution failure: %s' % str(e), ex=e)
+		while True:
+			try:
+				(pid, status, usage) = os.wait4(proc.pid, 0)
+				break
+			except OSError as e:
+				if e.errno != errno.EINTR:
+					raise
+		if os.WIFSIGNALED(status):
+			ret = -os.WTERMSIG(status)
+		else:
+			ret = os.WEXITSTATUS(status)
+		proc.returncode = ret
+
+		# ru_maxrss is in bytes on osx and in kilobytes elsewhere
+		rss = usage.ru_maxrss
+		if Utils.unversioned_sys_platform() == 'darwin':
+			rss //= 1024
+		(cpu, peak) = tsk.cs_rusage or (0.0, 0)
+		tsk.cs_rusage = (cpu + usage.ru_utime + usage.ru_stime, max(peak, rss))
+
+		for (f, log) in ((out, Logs.info), (err, Logs.error)):
+			f.seek(0)
+			data = f.read()
+			if data:
+				if not isinstance(data, str):
+					data = data.decode(sys.stdout.encoding or 'iso8859-1')
+				log(data.rstrip('\n'))
+	finally:
+		out.close()
+		err.close()
+	return ret
+
+def cache_task(cls):
+	"""
+	Class decorator restoring the outputs of the tasks from the artifact cache CS_CACHE_DIR
+	instead of running them, and storing the outputs of the tasks which ran (see :py:func:`cache_key`)
+	"""
+	run = cls.run
+	def run_cached(self):
+		if cache_enabled(self) and restore_outputs(self):
+			self.cs_cached = True
+			return 0
+		return run(self)
+	cls.run = run_cached
+
+	post_run = cls.post_run
+	def post_run_cached(self):
+		ret = post_run(self)
+		if cache_enabled(self) and not getattr(self, 'cs_cached', False):
+			store_outputs(self)
+		return ret
+	cls.post_run = post_run_cached
+	return cls
+
+CS_RESPONSE_DIR = '.cs_rsp'
+CS_RESPONSE_INDEX = 'index'
+
+def use_response_file(tsk, path):
+	"""
+	Record the response file of a task, and remove the previous file of the task when no
+	other task uses it, so that the response files do not pile up with each change of the
+	arguments. The names are kept in .cs_rsp/index between the builds.
+	"""
+	bld = tsk.generator.bld
+	name = os.path.basename(path)
+	stat_lock.acquire()
+	try:
+		try:
+			index = bld.cs_rsp_index
+		except AttributeError:
+			index = bld.cs_rsp_index = load_response_index(bld)
+			bld.add_post_fun(store_response_index)
+		old = index.get(tsk.uid())
+		index[tsk.uid()] = name
+		if old == name or old in index.values():
+			old = None
+	finally:
+		stat_lock.release()
+
+	if old:
+		try:
+			os.remove(os.path.join(os.path.dirname(path), old))
+		except OSError:
+			pass
+		else:
+			cs_stat(bld, 'response files removed')
+
+def load_response_index(bld):
+	try:
+		return pickle.loads(Utils.readf(os.path.join(bld.variant_dir, CS_RESPONSE_DIR, CS_RESPONSE_INDEX), 'rb'))
+	except Exception:
+		return {}
+
+def store_response_index(bld):
+	db = os.path.join(bld.variant_dir, CS_RESPONSE_DIR, CS_RESPONSE_INDEX)
+	try:
+		Utils.writef(db, pickle.dumps(bld.cs_rsp_index, -1), 'wb')
+	except (OSError, IOError):
+		Logs.warn('cs: could not store the response files in %r' % db)
+
+@profile_task
+@cache_task
 class mcs(Task.Task):
 	"""
 	Compile C# files
@@ -160,6 +843,44 @@ class mcs(Task.Task):
 	color   = 'YELLOW'
 	run_str = '${MCS} ${CSTYPE} ${CSFLAGS} ${ASS_ST:ASSEMBLIES} ${RES_ST:RESOURCES} ${OUT} ${SRC}'
 
+	def runnable_status(self):
+		ret = Task.Task.runnable_status(self)
+		if ret == Task.RUN_ME and self.env.CS_DETERMINISTIC:
+			# the outputs are signed by their contents, see Task.update_outputs
+			bld = self.generator.bld
+			try:
+				if bld.task_sigs[self.uid()] == self.signature():
+					for node in self.outputs:
+						if not node.sig or bld.task_sigs[node.abspath()] != self.uid():
+							return Task.RUN_ME
+					ret = Task.SKIP_ME
+			except KeyError:
+				return Task.RUN_ME
+		if ret == Task.SKIP_ME:
+			ref = getattr(self, 'ref_node', None)
+			if ref and not getattr(ref, 'sig', None):
+				return Task.RUN_ME
+		return ret
+
+	def post_run(self):
+		Task.Task.post_run(self)
+		if self.env.CS_DETERMINISTIC:
+			# identical assemblies get the same signature, the dependent tasks are then skipped
+			bld = self.generator.bld
+			for node in self.outputs:
+				node.sig = Utils.h_file(node.abspath())
+				bld.task_sigs[node.abspath()] = self.uid()
+		ref = getattr(self, 'ref_node', None)
+		if ref:
+			# the reference assembly is signed by its content and not by the task signature,
+			# it only changes when the public surface of the library changes
+			try:
+				ref.sig = Utils.h_file(ref.abspath())
+			except (OSError, IOError):
+				self.hasrun = Task.MISSING
+				self.err_msg = '-> missing file: %r' % ref.abspath()
+				raise Errors.WafError(self.err_msg)
+
 	def exec_command(self, cmd, **kw):
 		bld = self.generator.bld
 
@@ -169,24 +890,59 @@ class mcs(Task.Task):
 		except AttributeError:
 			bld.cwd = kw['cwd'] = bld.variant_dir
 
+		if isinstance(cmd, list) and (self.env.CS_RESPONSE_FILES or len(' '.join(cmd)) >= 8192):
+			program = cmd[0] #unquoted program name, otherwise exec_command will fail
+			cmd = [self.quote_response_command(x) for x in cmd]
+			cmd = [program, '@' + self.response_file('\r\n'.join(i.replace('\\', '\\\\') for i in cmd[1:]).encode())]
+		if isinstance(cmd, list) and self.env.CS_SERVER:
+			# the server flag stays on the command line (not in the response file)
+			# and out of the task signature: it does not change the output
+			cmd = cmd[:1] + self.server_flags() + cmd[1:]
+		return exec_rusage(self, cmd, **kw)
+
+	def response_file(self, data):
+		"""
+		Return the path of a response file holding *data*. The response files are named
+		by the hash of their contents and kept in the build directory, an existing file
+		is reused as it is and the same arguments always give the same path. The previous
+		file of the task is removed, see :py:func:`use_response_file`.
+		"""
+		bld = self.generator.bld
+		d = os.path.join(bld.variant_dir, CS_RESPONSE_DIR)
+		path = os.path.join(d, Utils.to_hex(Utils.md5(data).digest()) + '.rsp')
+		use_response_file(self, path)
+		if os.path.isfile(path):
+			cs_stat(bld, 'response files reused')
+			return path
+
 		try:
-			tmp = None
-			if isinstance(cmd, list) and len(' '.join(cmd)) >= 8192:
-				program = cmd[0] #unquoted program name, otherwise exec_command will fail
-				cmd = [self.quote_response_command(x) for x in cmd]
-				(fd, tmp) = tempfile.mkstemp()
-				os.write(fd, '\r\n'.join(i.replace('\\', '\\\\') for i in cmd[1:]).encode())
-				os.close(fd)
-				cmd = [program, '@' + tmp]
-			# no return here, that's on purpose
-			ret = self.generator.bld.exec_command(cmd, **kw)
+			os.makedirs(d)
+		except OSError:
+			if not os.path.isdir(d):
+				raise
+		(fd, tmp) = tempfile.mkstemp(dir=d)
+		try:
+			os.write(fd, data)
 		finally:
-			if tmp:
-				try:
-					os.remove(tmp)
-				except OSError:
-					pass # anti-virus and indexers can keep the files open -_-
-		return ret
+			os.close(fd)
+		try:
+			os.rename(tmp, path)
+		except OSError:
+			# another task wrote the same file, or the destination is in use
+			os.remove(tmp)
+		cs_stat(bld, 'response files written')
+		return path
+
+	def server_flags(self):
+		"""
+		Flags handing the compilation to a long-lived compiler server (csc /shared).
+		The compiler itself falls back to an in-process compilation when the server
+		cannot be reached.
+		"""
+		pipe = self.env.CS_SERVER_PIPE
+		if pipe:
+			return ['/shared:%s' % pipe]
+		return ['/shared']
 
 	def quote_response_command(self, flag):
 		# /noconfig is not allowed when using response files
@@ -203,9 +959,106 @@ class mcs(Task.Task):
 		return flag
 
 
+@profile_task
+@cache_task
+class cs_aot(Task.Task):
+	"""
+	Precompile an assembly (mono --aot=outfile=...). The task is keyed on the contents of
+	the assembly and of the assemblies it references, not on their task signatures: the
+	image is not compiled again when an assembly is rebuilt identically.
+	"""
+	color = 'CYAN'
+	vars = ['MONO', 'CS_AOT', 'CS_AOT_FLAGS']
+	compiler_var = 'MONO'
+
+	def sig_explicit_deps(self):
+		sig_contents(self)
+
+	def run(self):
+		node = self.inputs[0]
+		opts = ['outfile=%s' % self.outputs[0].abspath()] + Utils.to_list(self.env.CS_AOT)
+		cmd = Utils.to_list(self.env.MONO) + Utils.to_list(self.env.CS_AOT_FLAGS) + ['--aot=%s' % ','.join(opts), node.abspath()]
+
+		# the referenced assemblies are loaded by the compilation
+		env = dict(os.environ)
+		path = [node.parent.abspath()] + self.mono_path
+		if env.get('MONO_PATH'):
+			path.append(env['MONO_PATH'])
+		env['MONO_PATH'] = os.pathsep.join(path)
+		return self.exec_command(cmd, cwd=node.parent.abspath(), env=env)
+
+@profile_task
+@cache_task
+class cs_bundle(Task.Task):
+	"""
+	Pack a program and its assemblies (mkbundle -o program ..., or a zip archive), keyed on
+	the contents of the assemblies like :py:class:`cs_aot`
+	"""
+	color = 'CYAN'
+	vars = ['MKBUNDLE', 'MKBUNDLEFLAGS', 'CS_BUNDLE', 'CS_BUNDLE_COMPRESS']
+	compiler_var = 'MKBUNDLE'
+
+	def sig_explicit_deps(self):
+		sig_contents(self)
+
+	def run(self):
+		out = self.outputs[0].abspath()
+		if self.env.CS_BUNDLE == 'zip':
+			return self.write_zip(out)
+		cmd = Utils.to_list(self.env.MKBUNDLE) + Utils.to_list(self.env.MKBUNDLEFLAGS)
+		if self.env.CS_BUNDLE_COMPRESS:
+			cmd.append('-z')
+		cmd.extend(['-o', out])
+		cmd.extend(x.abspath() for x in self.inputs)
+		return self.exec_command(cmd, cwd=self.outputs[0].parent.abspath())
+
+	def write_zip(self, out):
+		# fixed dates, the same assemblies give the same archive
+		mode = self.env.CS_BUNDLE_COMPRESS and zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+		tmp = out + '.tmp'
+		z = zipfile.ZipFile(tmp, 'w', mode)
+		try:
+			for x in self.inputs:
+				info = zipfile.ZipInfo(x.name, (1980, 1, 1, 0, 0, 0))
+				info.compress_type = mode
+				info.external_attr = Utils.O644 << 16
+				z.writestr(info, Utils.readf(x.abspath(), 'rb'))
+		finally:
+			z.close()
+		os.rename(tmp, out)
+		return 0
+
+@profile_task
+@cache_task
+class al(Task.Task):
+	"""
+	Link the embedded resources into a resource assembly (al /embed:file,name), see
+	:py:func:`apply_cs_resources`
+	"""
+	color = 'YELLOW'
+	vars = ['AL', 'ALFLAGS', 'RESOURCES']
+	compiler_var = 'AL'
+
+	def run(self):
+		cmd = Utils.to_list(self.env.AL) + ['/nologo', '/target:library', '/out:%s' % self.outputs[0].abspath()]
+		cmd.extend(Utils.to_list(self.env.ALFLAGS))
+		cmd.extend('/embed:%s' % x for x in Utils.to_list(self.env.RESOURCES))
+		return self.exec_command(cmd)
+
+def sig_contents(tsk):
+	"""
+	Sign the inputs of a task by their contents instead of their task signatures
+	"""
+	bld = tsk.generator.bld
+	for x in tsk.inputs + tsk.dep_nodes:
+		tsk.m.update(content_sig(bld, x))
+
+
 def configure(conf):
 	"""
-	Find a C# compiler, set the variable MCS for the compiler and CS_NAME (mono or csc)
+	Find a C# compiler, set the variable MCS for the compiler and CS_NAME (mono or csc),
+	the mono runtime (MONO) for :py:func:`apply_cs_aot` and the assembly linker (AL)
+	for :py:func:`apply_cs_resources`
 	"""
 	csc = getattr(Options.options, 'cscbinary', None)
 	if csc:
@@ -219,6 +1072,28 @@ def configure(conf):
 		conf.env.CS_NAME = 'mono'
 
 	conf.env.package_dep_lib = getattr(Options.options, 'package_dep_lib', False)
+	conf.env.CS_BUNDLE = getattr(Options.options, 'package_dep_format', None) or 'mkbundle'
+	conf.env.CS_BUNDLE_COMPRESS = getattr(Options.options, 'package_dep_compress', False)
+	conf.env.CS_BUNDLE_PKG = getattr(Options.options, 'package_dep_pkg', False)
+	if conf.env.package_dep_lib and conf.env.CS_BUNDLE == 'mkbundle':
+		conf.find_program('mkbundle', var='MKBUNDLE')
+	conf.env.CS_COPY = getattr(Options.options, 'cs_copy', None) or 'copy'
+	conf.env.CS_DEV_LAYOUT = getattr(Options.options, 'cs_dev_layout', None) or 'local'
+	conf.env.CS_RESPONSE_FILES = getattr(Options.options, 'cs_response_files', False)
+	conf.env.CS_PRIORITY = not getattr(Options.options, 'cs_no_priority', False)
+
+	conf.find_program('mono', var='MONO', mandatory=False)
+	conf.find_program(['al', 'al2'], var='AL', mandatory=False)
+	conf.env.CS_AOT = getattr(Options.options, 'cs_aot_full', False) and ['full'] or []
+	conf.env.CS_AOT_FLAGS = getattr(Options.options, 'cs_aot_llvm', False) and ['--llvm'] or []
+	conf.env.CS_AOT_EXT = {'darwin': '.dylib', 'win32': '.dll'}.get(Utils.unversioned_sys_platform(), '.so')
+
+	cache = getattr(Options.options, 'cs_cache', None) or os.environ.get('CS_CACHE_DIR', None)
+	if cache:
+		conf.env.CS_CACHE_DIR = os.path.abspath(os.path.expanduser(cache))
+		conf.env.CS_CACHE_SIZE = int(getattr(Options.options, 'cs_cache_size', 5000)) * 1024 * 1024
+		conf.env.CS_CACHE_LINK = getattr(Options.options, 'cs_cache_link', None) or 'copy'
+		conf.msg('C# artifact cache', conf.env.CS_CACHE_DIR)
 
 	# new variable that allow the sdk version to be specified at the command line.
 	sdk_version = getattr(Options.options, 'sdk_version', None)
@@ -230,6 +1105,102 @@ def configure(conf):
 		conf.env.append_value('CSFLAGS', '/define:DEBUG')
 		conf.env.CSDEBUG = debug;
 
+	if getattr(Options.options, 'cs_server', False):
+		conf.check_cs_server()
+
+	conf.check_cs_refout()
+	conf.check_cs_deterministic()
+	conf.env.CS_DETERMINISTIC = getattr(Options.options, 'cs_deterministic', False)
+
+@conf
+def check_cs_server(self, pipe=None):
+	"""
+	Enable the compiler server mode of Roslyn csc (/shared and its VBCSCompiler server).
+	This is for csc only: with mcs, the default compiler, the check does nothing and
+	the build is not faster. The compiler and the referenced assemblies are then loaded
+	once for the whole build instead of once per assembly, the gain was not measured::
+
+		def configure(conf):
+			conf.load('cs')
+			conf.check_cs_server()
+
+	Mono mcs has no server mode, CS_SERVER stays False and the tasks keep spawning
+	one process per assembly.
+
+	:param pipe: Name of the pipe used to talk to the server, the compiler picks one by default
+	:type pipe: string
+	:return: True if the server mode is enabled
+	:rtype: bool
+	"""
+	self.start_msg('Checking for C# compiler server')
+	self.env.CS_SERVER = False
+
+	if self.env.CS_NAME == 'mono':
+		self.end_msg('not supported by %s' % os.path.basename(Utils.to_list(self.env.MCS)[0]), 'YELLOW')
+		return False
+
+	try:
+		self.cmd_and_log(Utils.to_list(self.env.MCS) + ['/shared', '/nologo', '/help'])
+	except self.errors.WafError:
+		self.end_msg('no', 'YELLOW')
+		return False
+
+	self.env.CS_SERVER = True
+	if pipe:
+		self.env.CS_SERVER_PIPE = pipe
+	self.end_msg('yes')
+	return True
+
+@conf
+def check_cs_refout(self):
+	"""
+	Check if the compiler can emit reference assemblies (/refout) and set CS_REFOUT.
+	Mono mcs cannot, the dependent assemblies are then keyed on the whole library.
+	"""
+	self.start_msg('Checking for C# reference assemblies')
+	self.env.CS_REFOUT = False
+
+	if self.env.CS_NAME != 'mono':
+		self.env.CS_REFOUT = self.cs_help().find('/refout') > -1
+
+	self.end_msg(self.env.CS_REFOUT and 'yes' or 'no', self.env.CS_REFOUT and 'GREEN' or 'YELLOW')
+	return self.env.CS_REFOUT
+
+@conf
+def check_cs_deterministic(self):
+	"""
+	Check if the compiler can produce deterministic assemblies (/deterministic) and map the
+	paths in the debug information (/pathmap), see :py:func:`deterministic_cs`. Mono mcs
+	cannot, the flags are then normalized and the outputs signed by their contents only.
+	"""
+	self.start_msg('Checking for C# deterministic output')
+	self.env.CS_DETERMINISTIC_FLAGS = []
+	self.env.CS_PATHMAP = False
+
+	if self.env.CS_NAME != 'mono':
+		out = self.cs_help()
+		if out.find('/deterministic') > -1:
+			self.env.CS_DETERMINISTIC_FLAGS = ['/deterministic']
+		self.env.CS_PATHMAP = out.find('/pathmap') > -1
+
+	ret = bool(self.env.CS_DETERMINISTIC_FLAGS)
+	self.end_msg(ret and 'yes' or 'no', ret and 'GREEN' or 'YELLOW')
+	return ret
+
+@conf
+def cs_help(self):
+	"""
+	Return the help text of the compiler (cached), used to find the supported flags
+	"""
+	try:
+		return self.cs_help_text
+	except AttributeError:
+		try:
+			self.cs_help_text = self.cmd_and_log(Utils.to_list(self.env.MCS) + ['/nologo', '/help'])
+		except self.errors.WafError:
+			self.cs_help_text = ''
+		return self.cs_help_text
+
 
 def options(opt):
 	"""
@@ -240,7 +1211,37 @@ def options(opt):
 	opt.add_option('--with-csc-binary', type='string', dest='cscbinary')
 	opt.add_option('--sdk', type='string', dest='sdk_version', default=None, help='Specifies SDK version of referenced assemlies')
 	opt.add_option('--package-dep', dest='package_dep_lib', action='store_true', default=False, help='Package all dependent library with project')
+	opt.add_option('--package-dep-format', type='choice', dest='package_dep_format', default='mkbundle', choices=('mkbundle', 'zip'),
+		help='Package the programs with mkbundle or in a zip archive [default: mkbundle]')
+	opt.add_option('--package-dep-compress', dest='package_dep_compress', action='store_true', default=False,
+		help='Compress the packaged assemblies (mkbundle -z)')
+	opt.add_option('--package-dep-pkg', dest='package_dep_pkg', action='store_true', default=False,
+		help='Package the assemblies of the pkg-config packages too')
 	opt.add_option('--debug', '-d', type='string', dest='debug', default=None, help='Enable debug')
+	opt.add_option('--cs-copy', type='choice', dest='cs_copy', default='copy', choices=('copy', 'hardlink', 'reflink', 'symlink'),
+		help='How the dependent libraries are put next to the cs_dev programs, a copy is made if the link fails [default: copy]')
+	opt.add_option('--cs-dev-layout', type='choice', dest='cs_dev_layout', default='local', choices=('local', 'shared'),
+		help='Put the cs_dev programs and their libraries in one shared directory per variant (shared) or copy the libraries next to each program (local) [default: local]')
+	opt.add_option('--cs-response-files', dest='cs_response_files', action='store_true', default=False,
+		help='Always pass the compiler arguments in a response file, not only for long command lines')
+	opt.add_option('--cs-profile', dest='cs_profile', action='store_true', default=False,
+		help='Record the profiles of the tasks in build/cs_profile.json and .csv, see waf cs_profile')
+	opt.add_option('--cs-profile-top', type='int', dest='cs_profile_top', default=10, help='Number of targets displayed by waf cs_profile [default: 10]')
+	opt.add_option('--cs-cache', type='string', dest='cs_cache', default=None,
+		help='Directory of the artifact cache shared by the builds, may be on NFS [default: $CS_CACHE_DIR]')
+	opt.add_option('--cs-cache-size', type='int', dest='cs_cache_size', default=5000,
+		help='Size of the artifact cache in MB, the least recently used entries are removed [default: 5000]')
+	opt.add_option('--cs-cache-link', type='choice', dest='cs_cache_link', default='copy', choices=('copy', 'hardlink', 'reflink'),
+		help='How the outputs are restored from the artifact cache, a copy is made if the link fails [default: copy]')
+	opt.add_option('--cs-no-priority', dest='cs_no_priority', action='store_true', default=False,
+		help='Do not start the C# targets by order of their critical path, see cs_priorities')
+	opt.add_option('--cs-deterministic', dest='cs_deterministic', action='store_true', default=False,
+		help='Compile reproducible assemblies, the dependent targets are skipped when an assembly is rebuilt identically')
+	opt.add_option('--cs-aot-full', dest='cs_aot_full', action='store_true', default=False,
+		help='Full ahead-of-time compilation of the cs_aot targets (mono --aot=full)')
+	opt.add_option('--cs-aot-llvm', dest='cs_aot_llvm', action='store_true', default=False,
+		help='Use the LLVM backend for the cs_aot targets (mono --llvm)')
+	opt.add_option('--cs-server', dest='cs_server', action='store_true', default=False, help='Keep a compiler server running for the whole build, Roslyn csc only (/shared), no effect with mcs')
 
 
 class fake_csshlib(Task.Task):
@@ -251,31 +1252,569 @@ class fake_csshlib(Task.Task):
 	inst_to = None
 
 	def runnable_status(self):
+		t = time.time()
 		for x in self.outputs:
-			x.sig = Utils.h_file(x.abspath())
+			x.sig = x.cache_sig = h_assembly(self.generator.bld, x)
+		record_profile(self, time.time() - t, self.outputs)
 		return Task.SKIP_ME
 
-@conf
-def read_csshlib(self, name, paths=[]):
+@feature('fake_cs')
+def process_fake_cs(self):
 	"""
-	Read a foreign .net assembly for the *use* system::
+	Find a foreign .net assembly for :py:func:`read_csshlib`, like :py:func:`waflib.Tools.ccroot.process_lib`
+	but without hashing the file (see :py:func:`h_assembly`)
+	"""
+	for x in self.lib_paths + [self.path] + ccroot.SYSTEM_LIB_PATHS:
+		if not isinstance(x, Node.Node):
+			x = self.bld.root.find_node(x) or self.path.find_node(x)
+			if not x:
+				continue
+		node = x.find_node(self.name)
+		if node:
+			break
+	else:
+		raise Errors.WafError('could not find assembly %r' % self.name)
 
-		def build(bld):
-			bld.read_csshlib('ManagedLibrary.dll', paths=[bld.env.mylibrarypath])
-			bld(features='cs', source='Hi.cs', bintype='exe', gen='hi.exe', use='ManagedLibrary.dll')
+	self.link_task = self.create_task('fake_csshlib', [], [node])
+	self.target = self.name
 
-	:param name: Name of the library
-	:type name: string
-	:param paths: Folders in which the library may be found
-	:type paths: list of string
-	:return: A task generator having the feature *fake_lib* which will call :py:func:`waflib.Tools.ccroot.process_lib`
-	:rtype: :py:class:`waflib.TaskGen.task_gen`
+stat_lock = Utils.threading.Lock()
+
+def cs_stat(bld, name, value=1):
+	"""
+	Add *value* to the build counter *name*, may be called from the task threads.
+	The counters are displayed at the end of the build with *waf -v --zones=cs*.
+	"""
+	stat_lock.acquire()
+	try:
+		try:
+			stats = bld.cs_stats
+		except AttributeError:
+			stats = bld.cs_stats = {}
+			bld.add_post_fun(display_stats)
+		stats[name] = stats.get(name, 0) + value
+	finally:
+		stat_lock.release()
+
+def display_stats(bld):
+	for k in sorted(bld.cs_stats.keys()):
+		Logs.debug('cs: %s: %d' % (k, bld.cs_stats[k]))
+	if profile_enabled() and not hasattr(bld, 'cs_profile'):
+		# no task ran, the counters are stored with the previous profiles
+		store_profile(bld)
+
+CS_PROFILE = 'cs_profile'
+
+def profile_enabled():
+	"""
+	The task profiles are only recorded and written with *waf --cs-profile*
+	"""
+	return getattr(Options.options, 'cs_profile', False)
+
+def record_profile(tsk, wall, inputs=None):
+	"""
+	Add the profile of a task to the build, it is written by :py:func:`store_profile`
+	at the end of the build
+
+	:param wall: duration of the task in seconds
+	:param inputs: the files processed, the task inputs by default
+	"""
+	if not profile_enabled():
+		return
+	if inputs is None:
+		inputs = tsk.inputs
+	size = 0
+	for x in inputs:
+		try:
+			size += os.path.getsize(x.abspath())
+		except OSError:
+			pass
+	(cpu, rss) = getattr(tsk, 'cs_rusage', None) or (None, None)
+
+	bld = tsk.generator.bld
+	entry = {
+		'task': tsk.__class__.__name__,
+		'target': str(tsk.generator.name),
+		'output': tsk.outputs and tsk.outputs[0].bldpath() or '',
+		'wall': round(wall, 4),
+		'cpu': cpu is not None and round(cpu, 4) or cpu,
+		'maxrss': rss,
+		'inputs': len(inputs),
+		'bytes': size,
+	}
+
+	stat_lock.acquire()
+	try:
+		try:
+			bld.cs_profile.append(entry)
+		except AttributeError:
+			bld.cs_profile = [entry]
+			bld.add_post_fun(store_profile)
+	finally:
+		stat_lock.release()
+
+def load_profile(path):
+	try:
+		return json.loads(Utils.readf(path))
+	except (IOError, OSError, ValueError):
+		return {'tasks': [], 'graph': {}, 'stats': {}}
+
+def store_profile(bld):
+	"""
+	Write the task profiles to cs_profile.json and cs_profile.csv in the build directory.
+	The tasks which did not run in this build keep the profile of their last run, and
+	the *use* graph of the C# targets is stored for the critical path of *waf cs_profile*.
+	"""
+	path = os.path.join(bld.variant_dir, CS_PROFILE)
+	report = load_profile(path + '.json')
+
+	profile = getattr(bld, 'cs_profile', [])
+	keys = set((x['task'], x['output']) for x in profile)
+	tasks = [x for x in report['tasks'] if not (x['task'], x['output']) in keys]
+	tasks.extend(profile)
+	tasks.sort(key=lambda x: -x['wall'])
+
+	graph = report['graph']
+	for tg in bld.get_all_task_gen():
+		if getattr(tg, 'cs_task', None):
+			graph[str(tg.name)] = [str(x.name) for x in tg.cs_references(transitive=False) if x.kind == 'project']
+
+	report = {'tasks': tasks, 'graph': graph, 'stats': getattr(bld, 'cs_stats', {})}
+	columns = ['target', 'task', 'output', 'wall', 'cpu', 'maxrss', 'inputs', 'bytes']
+	lines = [','.join(columns)]
+	for x in tasks:
+		lines.append(','.join(csv_value(x[k]) for k in columns))
+	try:
+		Utils.writef(path + '.json', json.dumps(report, indent=1, sort_keys=True))
+		Utils.writef(path + '.csv', '\n'.join(lines) + '\n')
+	except (OSError, IOError):
+		Logs.warn('cs: could not store the task profiles in %r' % path)
+
+def csv_value(x):
+	if x is None:
+		return ''
+	x = str(x)
+	if x.find(',') > -1 or x.find('"') > -1:
+		x = '"%s"' % x.replace('"', '""')
+	return x
+
+def critical_path(durations, graph):
+	"""
+	Return the chain of targets taking the longest time to build when the targets
+	are built as soon as the targets they *use* are built
+
+	:param durations: target name -> duration
+	:param graph: target name -> names of the targets used
+	:return: a tuple (total duration, list of target names, used first)
+	"""
+	cache = {}
+	def longest(name, stack):
+		try:
+			return cache[name]
+		except KeyError:
+			pass
+		best = (0.0, [])
+		if not name in stack:
+			stack.add(name)
+			for x in graph.get(name, []):
+				best = max(best, longest(x, stack))
+			stack.discard(name)
+		cache[name] = ret = (best[0] + durations.get(name, 0.0), best[1] + [name])
+		return ret
+
+	ret = (0.0, [])
+	for x in set(durations.keys()) | set(graph.keys()):
+		ret = max(ret, longest(x, set()))
+	return ret
+
+class ProfileContext(Build.BuildContext):
+	"""prints the slowest C# targets and the critical path of the last builds"""
+	cmd = 'cs_profile'
+
+	def execute(self):
+		path = os.path.join(self.variant_dir, CS_PROFILE + '.json')
+		report = load_profile(path)
+		if not report['tasks']:
+			raise Errors.WafError('No task profile in %r, run a build with --cs-profile first' % path)
+
+		targets = {}
+		for x in report['tasks']:
+			t = targets.setdefault(x['target'], {'wall': 0.0, 'cpu': 0.0, 'maxrss': 0, 'inputs': 0, 'bytes': 0})
+			for k in ('wall', 'cpu', 'inputs', 'bytes'):
+				t[k] += x[k] or 0
+			t['maxrss'] = max(t['maxrss'], x['maxrss'] or 0)
+
+		top = getattr(Options.options, 'cs_profile_top', 10)
+		Logs.info('Slowest targets (%s):' % path)
+		Logs.info('%10s %10s %10s %7s %10s  %s' % ('wall (s)', 'cpu (s)', 'rss (MB)', 'inputs', 'KB', 'target'))
+		for (name, t) in sorted(targets.items(), key=lambda x: -x[1]['wall'])[:top]:
+			Logs.info('%10.2f %10.2f %10.1f %7d %10d  %s' % (t['wall'], t['cpu'], t['maxrss'] / 1024.0, t['inputs'], t['bytes'] // 1024, name))
+
+		(total, chain) = critical_path(dict((k, v['wall']) for (k, v) in targets.items()), report['graph'])
+		Logs.info('Critical path through the use graph: %.2fs' % total)
+		for x in chain:
+			Logs.info('  %8.2fs  %s' % (targets.get(x, {}).get('wall', 0.0), x))
+
+		if report['stats']:
+			Logs.info('Counters of the last build:')
+			for k in sorted(report['stats'].keys()):
+				Logs.info('  %10d  %s' % (report['stats'][k], k))
+
+def cs_priorities(bld):
+	"""
+	Compute the priorities of the C# targets: the time to build the target and the longest
+	chain of targets using it, with the durations of mcs recorded by the previous builds
+	run with *--cs-profile* (see :py:func:`store_profile`). The targets without a recorded
+	duration count for the average duration, so the priority is the length of the chain
+	when no profile was recorded.
+
+	:return: a dict mapping the task generators to their priority
+	"""
+	report = load_profile(os.path.join(bld.variant_dir, CS_PROFILE + '.json'))
+	durations = {}
+	for x in report['tasks']:
+		if x['task'] == 'mcs':
+			durations[x['target']] = durations.get(x['target'], 0.0) + x['wall']
+	default = durations and sum(durations.values()) / len(durations) or 1.0
+
+	tgs = [tg for tg in bld.get_all_task_gen() if getattr(tg, 'cs_task', None) and tg.env.CS_PRIORITY]
+	users = dict((tg, []) for tg in tgs)
+	for tg in tgs:
+		for x in tg.cs_references(transitive=False):
+			if x.kind == 'project' and x.tg in users:
+				users[x.tg].append(tg)
+
+	ret = {}
+	def priority(tg, stack):
+		try:
+			return ret[tg]
+		except KeyError:
+			pass
+		best = 0.0
+		if not tg in stack:
+			stack.add(tg)
+			for x in users[tg]:
+				best = max(best, priority(x, stack))
+			stack.discard(tg)
+		ret[tg] = val = best + durations.get(str(tg.name), default)
+		return val
+	for tg in tgs:
+		priority(tg, set())
+	return ret
+
+def task_priority(tsk):
+	try:
+		return tsk.cs_priority
+	except AttributeError:
+		bld = getattr(tsk.generator, 'bld', None)
+		if not bld:
+			return 0.0
+		try:
+			table = bld.cs_priority_table
+		except AttributeError:
+			table = bld.cs_priority_table = cs_priorities(bld)
+		tsk.cs_priority = table.get(tsk.generator, 0.0)
+		return tsk.cs_priority
+
+class Parallel(Runner.Parallel):
+	"""
+	Waf runs the tasks in the order of the task generators, the C# tasks are started by
+	decreasing priority instead (see :py:func:`cs_priorities`) so that the slow targets
+	at the start of long *use* chains do not end up building alone at the end. The sort
+	is stable, the order of the other tasks is unchanged.
+	"""
+	def refill_task_list(self):
+		empty = not self.outstanding
+		super(Parallel, self).refill_task_list()
+		if empty and len(self.outstanding) > 1:
+			self.outstanding.sort(key=lambda x: -task_priority(x))
+
+def setup(bld):
+	# called when the build restores the tools of the configuration
+	bld.add_pre_fun(use_priorities)
+
+def use_priorities(bld):
+	"""
+	Start the C# tasks by priority (see :py:class:`Parallel`) unless the project was
+	configured with *--cs-no-priority*. The scheduler is set before the build starts,
+	the projects which do not use this tool keep the one of waf.
+	"""
+	if bld.env.CS_PRIORITY:
+		Runner.Parallel = Parallel
+	elif Runner.Parallel is Parallel:
+		Runner.Parallel = Parallel.__bases__[0]
+
+CS_HASHES = '.cs_hashes'
+
+def h_assembly(bld, node):
+	"""
+	Hash a foreign assembly. The hashes are kept in the build directory and only
+	recomputed when the size, the modification time or the inode of the file changed.
+	The counters are displayed with *waf -v --zones=cs* (see :py:func:`cs_stat`).
+
+	:param node: assembly
+	:type node: :py:class:`waflib.Node.Node`
+	:return: the hash of the file
+	"""
+	try:
+		cache = bld.cs_hashes
+	except AttributeError:
+		cache = bld.cs_hashes = load_hashes(bld)
+		bld.add_post_fun(store_hashes)
+
+	path = node.abspath()
+	st = os.stat(path)
+	key = (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
+	try:
+		(k, sig) = cache[path]
+	except KeyError:
+		pass
+	else:
+		if k == key:
+			cs_stat(bld, 'assembly hashes read from the cache')
+			return sig
+
+	sig = Utils.h_file(path)
+	cache[path] = (key, sig)
+	cs_stat(bld, 'assembly hashes recomputed')
+	bld.cs_hashes_dirty = True
+	return sig
+
+def load_hashes(bld):
+	try:
+		return pickle.loads(Utils.readf(os.path.join(bld.variant_dir, CS_HASHES), 'rb'))
+	except Exception:
+		return {}
+
+def store_hashes(bld):
+	if not getattr(bld, 'cs_hashes_dirty', False):
+		return
+
+	db = os.path.join(bld.variant_dir, CS_HASHES)
+	try:
+		Utils.writef(db + '.tmp', pickle.dumps(bld.cs_hashes, -1), 'wb')
+		try:
+			os.unlink(db)
+		except OSError:
+			pass
+		os.rename(db + '.tmp', db)
+	except (OSError, IOError):
+		Logs.warn('cs: could not store the assembly hashes in %r' % db)
+
+CS_CACHE_VERSION = 'cs-cache-1'
+
+def cache_enabled(tsk):
+	bld = tsk.generator.bld
+	return tsk.env.CS_CACHE_DIR and not getattr(bld, 'nocache', False)
+
+def cache_nodes(tsk):
+	"""
+	The files stored in the artifact cache for a task: its outputs and its reference assembly
+	"""
+	ref = getattr(tsk, 'ref_node', None)
+	return tsk.outputs + (ref and [ref] or [])
+
+def content_sig(bld, node):
+	"""
+	Hash of the contents of a file, the build files are signed by their task and not by their contents
+	"""
+	if not node.is_child_of(bld.bldnode):
+		return getattr(node, 'sig', None) or node.get_bld_sig()
+	path = node.abspath()
+	try:
+		cache = bld.cs_content_sigs
+	except AttributeError:
+		cache = bld.cs_content_sigs = {}
+	try:
+		return cache[path]
+	except KeyError:
+		cache[path] = ret = Utils.h_file(path)
+		return ret
+
+def compiler_id(bld, env, var='MCS'):
+	"""
+	Hash of the compiler command and of the compiler file, computed once per build
+	"""
+	cmd = Utils.to_list(env[var])
+	stat_lock.acquire()
+	try:
+		try:
+			cache = bld.cs_compiler_ids
+		except AttributeError:
+			cache = bld.cs_compiler_ids = {}
+		key = tuple(cmd)
+		if not key in cache:
+			m = Utils.md5()
+			m.update(repr(cmd).encode())
+			try:
+				m.update(Utils.h_file(cmd[0]))
+			except (OSError, IOError, IndexError):
+				pass
+			cache[key] = m.digest()
+		return cache[key]
+	finally:
+		stat_lock.release()
+
+def cache_key(tsk):
+	"""
+	Key of a task in the artifact cache: the compiler, the command-line variables and the
+	contents of the inputs and of the referenced assemblies (the dependency nodes, the
+	foreign assemblies are added by :py:func:`use_cs`). The paths of the source and of
+	the build directories are replaced by placeholders so that the workspaces checked out
+	in different folders share their entries.
+	"""
+	bld = tsk.generator.bld
+	roots = [(bld.bldnode.abspath(), '${BLD}'), (bld.srcnode.abspath(), '${SRC}')]
+	def norm(x):
+		for (k, v) in roots:
+			x = x.replace(k, v)
+		return x.encode()
+
+	m = Utils.md5()
+	m.update(CS_CACHE_VERSION.encode())
+	m.update(compiler_id(bld, tsk.env, getattr(tsk, 'compiler_var', 'MCS')))
+	for x in tsk.vars:
+		m.update(norm('%s=%s;' % (x, tsk.env.get_flat(x))))
+	for x in tsk.inputs + tsk.dep_nodes:
+		m.update(norm(x.abspath()))
+		m.update(content_sig(bld, x))
+	for x in cache_nodes(tsk):
+		m.update(norm(x.abspath()))
+	return Utils.to_hex(m.digest())
+
+def cache_entry(tsk):
+	key = cache_key(tsk)
+	return os.path.join(tsk.env.CS_CACHE_DIR, key[:2], key)
+
+def restore_outputs(tsk):
+	"""
+	Copy or link the outputs of a task from the artifact cache
+
+	:return: True if the outputs were restored
+	"""
+	bld = tsk.generator.bld
+	nodes = cache_nodes(tsk)
+	try:
+		d = cache_entry(tsk)
+		if os.path.isdir(d):
+			mode = tsk.env.CS_CACHE_LINK or 'copy'
+			size = 0
+			for (i, node) in enumerate(nodes):
+				src = os.path.join(d, str(i))
+				dst = node.abspath()
+				if mode == 'copy' or not link_file(mode, src, dst):
+					shutil.copy2(src, dst)
+				size += os.path.getsize(dst)
+			# the entries are evicted by order of last use
+			os.utime(d, None)
+			cs_stat(bld, 'cache hits')
+			cs_stat(bld, 'cache bytes restored', size)
+			Logs.debug('cs: restored %r from the cache' % [x.abspath() for x in nodes])
+			return True
+	except (OSError, IOError):
+		Logs.debug('cs: could not restore %r from the cache' % tsk)
+
+	cs_stat(bld, 'cache misses')
+	# the outputs may be linked to the cache, and the compiler may write them in place
+	for node in nodes:
+		try:
+			os.remove(node.abspath())
+		except OSError:
+			pass
+	return False
+
+def store_outputs(tsk):
+	"""
+	Copy the outputs of a task to the artifact cache, the entry is renamed in place once
+	complete so that the other builds never see a partial entry
+	"""
+	bld = tsk.generator.bld
+	try:
+		d = cache_entry(tsk)
+		if os.path.isdir(d):
+			return
+		try:
+			os.makedirs(os.path.dirname(d))
+		except OSError:
+			pass
+		tmp = tempfile.mkdtemp(prefix='tmp', dir=tsk.env.CS_CACHE_DIR)
+		try:
+			for (i, node) in enumerate(cache_nodes(tsk)):
+				shutil.copy2(node.abspath(), os.path.join(tmp, str(i)))
+			os.chmod(tmp, Utils.O755)
+			os.rename(tmp, d)
+		except (OSError, IOError):
+			shutil.rmtree(tmp, ignore_errors=True)
+			return
+	except (OSError, IOError):
+		Logs.debug('cs: could not store %r in the cache' % tsk)
+		return
+
+	cs_stat(bld, 'cache entries stored')
+	stat_lock.acquire()
+	try:
+		if not getattr(bld, 'cs_cache_stored', False):
+			bld.cs_cache_stored = True
+			bld.add_post_fun(evict_cache)
+	finally:
+		stat_lock.release()
+
+def evict_cache(bld):
+	"""
+	Remove the least recently used entries of the artifact cache until its size is below
+	CS_CACHE_SIZE (in bytes)
+	"""
+	root = bld.env.CS_CACHE_DIR
+	limit = bld.env.CS_CACHE_SIZE
+	if not root or not limit:
+		return
+
+	entries = []
+	total = 0
+	for x in Utils.listdir(root):
+		p = os.path.join(root, x)
+		if len(x) != 2 or not os.path.isdir(p):
+			continue
+		for y in Utils.listdir(p):
+			d = os.path.join(p, y)
+			try:
+				size = sum(os.path.getsize(os.path.join(d, z)) for z in Utils.listdir(d))
+				entries.append((os.stat(d).st_mtime, size, d))
+			except OSError:
+				continue
+			total += size
+
+	entries.sort()
+	for (t, size, d) in entries:
+		if total <= limit:
+			break
+		shutil.rmtree(d, ignore_errors=True)
+		total -= size
+		cs_stat(bld, 'cache entries evicted')
+	Logs.debug('cs: cache size: %d bytes' % total)
+
+@conf
+def read_csshlib(self, name, paths=[]):
+	"""
+	Read a foreign .net assembly for the *use* system::
+
+		def build(bld):
+			bld.read_csshlib('ManagedLibrary.dll', paths=[bld.env.mylibrarypath])
+			bld(features='cs', source='Hi.cs', bintype='exe', gen='hi.exe', use='ManagedLibrary.dll')
+
+	:param name: Name of the library
+	:type name: string
+	:param paths: Folders in which the library may be found
+	:type paths: list of string
+	:return: A task generator having the feature *fake_cs* which will call :py:func:`process_fake_cs`
+	:rtype: :py:class:`waflib.TaskGen.task_gen`
 	"""
 	try:
 		return self.get_tgen_by_name(name)
 	except Errors.WafError:
 		pass
-	return self(name=name, features='fake_lib', lib_paths=paths, lib_type='csshlib')
+	return self(name=name, features='fake_cs', lib_paths=paths, lib_type='csshlib')
 
 @conf
 def read_assembly(self, name, install_path = None):
@@ -302,6 +1841,12 @@ def read_assembly(self, name, install_path = None):
 			self.fatal('Can\'t find assembly path')
 		f = d.find_node(filename)
 		self.install_files(install_path, f)
+		# the folders of the precompiled images (cs_aot)
+		try:
+			dests = self.cs_assembly_dests
+		except AttributeError:
+			dests = self.cs_assembly_dests = {}
+		dests.setdefault(f, []).append(install_path)
 
 		return tg
 
@@ -328,21 +1873,57 @@ def res_to_str(res, namespace = None):
 	return '{0},{1}'.format(path, link)
 
 
-@conf
 def check_pkg(self, *k, **kw):
-	if k:
-		lst = k[0].split()
-		kw['package'] = lst[0]
-		kw['args'] = ' '.join(lst[1:])
+	"""
+	Check a package with pkg-config, the assemblies are added to CSFLAGS_<USELIB>::
+
+		def configure(conf):
+			conf.check_pkg('gtk-sharp-2.0')
+			conf.check_pkg('glib-sharp-2.0', uselib_store='GLIB')
+			conf.check_pkg(['gio-sharp-2.0', 'gconf-sharp-2.0', 'gnome-sharp-2.0'])
+
+	The packages of a list are queried concurrently and checked one by one under their own
+	names, with *mandatory=False* the missing packages are None in the returned list. The output
+	of pkg-config is cached in the cache folder and reused while the PKG_CONFIG variables
+	and the .pc files do not change (see :py:func:`cached_pkg_config`).
+	"""
+	mandatory = kw.pop('mandatory', True)
+	if k and isinstance(k[0], (list, tuple)):
+		args = Utils.to_list(kw.pop('args', []))
+		names = [' '.join([x] + args) for x in k[0]]
+		if cacheable_pkg(kw):
+			cmds = []
+			for x in names:
+				dct = pkg_kw((x,), dict(kw))
+				self.validate_cfg(dct)
+				cmds.append(self.pkg_config_cmd(dct))
+			self.cached_pkg_config(cmds)
+
+		ret = []
+		missing = []
+		for x in names:
+			try:
+				ret.append(self.check_pkg(x, **dict(kw)))
+			except self.errors.ConfigurationError:
+				ret.append(None)
+				missing.append(x)
+		if missing and mandatory:
+			self.fatal('Could not find the packages %s' % ', '.join(missing))
+		return ret
 
+	kw = pkg_kw(k, kw)
 	env = kw.get('env', self.env)
 	uselib = kw.get('uselib_store', kw['package']).upper()
 
-	if 'args' in kw:
-		kw['args'] = Utils.to_list(kw['args'])
-		kw['args'].append('--libs')
-
-	ret = self.check_cfg(**kw)
+	try:
+		if cacheable_pkg(kw):
+			ret = self.check_cached_pkg(kw)
+		else:
+			ret = self.check_cfg(**kw)
+	except self.errors.ConfigurationError:
+		if mandatory:
+			raise
+		return None
 
 	if self.get_define(self.have_define(kw.get('uselib_store', kw['package']))):
 
@@ -354,6 +1935,187 @@ def check_pkg(self, *k, **kw):
 
 	return ret
 
+# not @conf, which removes *mandatory*: the checks of a list need it
+ConfigurationContext.check_pkg = Build.BuildContext.check_pkg = check_pkg
+
+def pkg_kw(k, kw):
+	if k:
+		lst = k[0].split()
+		kw['package'] = lst[0]
+		kw['args'] = ' '.join(lst[1:])
+
+	if 'args' in kw:
+		kw['args'] = Utils.to_list(kw['args'])
+		kw['args'].append('--libs')
+	return kw
+
+def cacheable_pkg(kw):
+	"""
+	The version checks and the variables are left to check_cfg
+	"""
+	for x in ['atleast_pkgconfig_version', 'modversion', 'variables'] + [y.replace('-', '_') for y in c_config.cfg_ver]:
+		if x in kw:
+			return False
+	return True
+
+@conf
+def pkg_config_cmd(self, kw):
+	"""
+	The pkg-config command line of check_cfg for *kw*
+	"""
+	lst = Utils.to_list(kw['path'])
+	defi = kw.get('define_variable', None) or self.env.PKG_CONFIG_DEFINES or {}
+	for key, val in defi.items():
+		lst.append('--define-variable=%s=%s' % (key, val))
+	lst.extend(Utils.to_list(kw.get('args', [])))
+	lst.extend(Utils.to_list(kw['package']))
+	return lst
+
+@conf
+def check_cached_pkg(self, kw):
+	"""
+	check_cfg with the pkg-config output of :py:func:`cached_pkg_config`
+	"""
+	self.validate_cfg(kw)
+	self.start_msg(kw['msg'])
+
+	(code, out, err) = self.cached_pkg_config([self.pkg_config_cmd(kw)])[0]
+	if code:
+		self.to_log(err)
+		self.end_msg(kw['errmsg'], 'YELLOW')
+		self.fatal('The configuration failed')
+
+	self.define(self.have_define(kw.get('uselib_store', kw['package'])), 1, 0)
+	self.parse_flags(out, kw.get('uselib_store', kw['package'].upper()), kw.get('env', self.env))
+	kw['success'] = out
+	self.end_msg(self.ret_msg(kw['okmsg'], kw))
+	return out
+
+def run_pkg_config(cmd):
+	try:
+		proc = Utils.subprocess.Popen(cmd, stdout=Utils.subprocess.PIPE, stderr=Utils.subprocess.PIPE)
+		(out, err) = proc.communicate()
+	except OSError as e:
+		return (-1, '', str(e))
+	if not isinstance(out, str):
+		out = out.decode(sys.stdout.encoding or 'iso8859-1')
+		err = err.decode(sys.stdout.encoding or 'iso8859-1')
+	return (proc.returncode, out, err)
+
+@conf
+def cached_pkg_config(self, cmds):
+	"""
+	Run pkg-config commands, concurrently when there are several. The results are kept
+	in the cache folder (see :py:func:`probe_cache`) and reused while the stamp of
+	:py:func:`pkg_config_stamp` is the same, an unchanged configuration does not run
+	pkg-config at all.
+
+	:param cmds: pkg-config command lines
+	:return: a list of (exit code, output, errors)
+	"""
+	cache = self.probe_cache()
+	stamp = self.pkg_config_stamp()
+
+	ret = {}
+	todo = []
+	for cmd in cmds:
+		key = ('pkg', tuple(cmd))
+		try:
+			(k, v) = cache[key]
+		except KeyError:
+			pass
+		else:
+			if k == stamp:
+				self.to_log('cs: cached %r' % cmd)
+				ret[key] = v
+				continue
+		if not key in todo:
+			todo.append(key)
+
+	if todo:
+		if len(todo) > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(len(todo), 8))
+			try:
+				lst = pool.map(run_pkg_config, [list(x[1]) for x in todo])
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			lst = [run_pkg_config(list(todo[0][1]))]
+
+		for (key, v) in zip(todo, lst):
+			self.to_log('%r\n%s%s' % (list(key[1]), v[1], v[2]))
+			cache[key] = (stamp, v)
+			ret[key] = v
+		self.store_probe_cache()
+
+	return [ret[('pkg', tuple(x))] for x in cmds]
+
+@conf
+def pkg_config_stamp(self):
+	"""
+	Hash the PKG_CONFIG variables of the environment, and the names and the modification
+	times of the .pc files in the pkg-config search path. The default search path of
+	pkg-config is cached too, so computing the stamp does not run any process.
+	"""
+	try:
+		return self.cs_pkg_stamp
+	except AttributeError:
+		pass
+
+	environ = getattr(self, 'environ', os.environ)
+	variables = sorted((k, v) for (k, v) in environ.items() if k.startswith('PKG_CONFIG'))
+
+	dirs = environ.get('PKG_CONFIG_PATH', '').split(os.pathsep)
+	if 'PKG_CONFIG_LIBDIR' in environ:
+		dirs.extend(environ['PKG_CONFIG_LIBDIR'].split(os.pathsep))
+	else:
+		dirs.extend(self.pkg_config_path().split(os.pathsep))
+
+	m = Utils.md5()
+	m.update(repr(variables).encode())
+	for d in dirs:
+		if not d:
+			continue
+		try:
+			lst = sorted(x for x in os.listdir(d) if x.endswith('.pc'))
+		except OSError:
+			continue
+		m.update(repr(d).encode())
+		for x in lst:
+			try:
+				st = os.stat(os.path.join(d, x))
+			except OSError:
+				continue
+			m.update(repr((x, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))).encode())
+
+	self.cs_pkg_stamp = m.digest()
+	return self.cs_pkg_stamp
+
+@conf
+def pkg_config_path(self):
+	"""
+	The default search path of pkg-config, cached while the pkg-config binary does not change
+	"""
+	if not self.env.PKGCONFIG:
+		self.find_program('pkg-config', var='PKGCONFIG')
+	path = Utils.to_list(self.env.PKGCONFIG)
+
+	cache = self.probe_cache()
+	key = ('pc_path', tuple(path), dir_stamp(path[0]))
+	try:
+		return cache[key]
+	except KeyError:
+		pass
+
+	try:
+		ret = self.cmd_and_log(path + ['--variable', 'pc_path', 'pkg-config']).strip()
+	except Errors.WafError:
+		ret = ''
+	cache[key] = ret
+	self.store_probe_cache()
+	return ret
 
 @conf
 def check_assembly(self, *k, **kw):
@@ -381,14 +2143,16 @@ def check_assembly(self, *k, **kw):
 		names += '.dll'
 
 	try:
-		ret = self.find_file(names, path_list=paths)
-		if ret:
-			self.define(self.have_define(kw.get('uselib_store', kw['package'])), 1, 0)
-			uselib = kw.get('uselib_store', kw['package']).upper()
-			env.append_value('CSFLAGS_' + uselib, '-r:' + os.path.abspath(ret))
+		ret = self.find_assembly(names, paths)
+		if not ret:
+			self.fatal('Could not find %r' % names)
+
+		self.define(self.have_define(kw.get('uselib_store', kw['package'])), 1, 0)
+		uselib = kw.get('uselib_store', kw['package']).upper()
+		env.append_value('CSFLAGS_' + uselib, '-r:' + os.path.abspath(ret))
 
-			if not 'okmsg' in kw:
-				kw['okmsg'] = 'yes'
+		if not 'okmsg' in kw:
+			kw['okmsg'] = 'yes'
 
 	except self.errors.WafError:
 		if 'errmsg' in kw:
@@ -405,6 +2169,164 @@ def check_assembly(self, *k, **kw):
 	return ret
 
 
+@conf
+def check_assemblies(self, names, **kw):
+	"""
+	Check several assemblies in the same folders, the folders are listed only once
+	(see :py:func:`index_assembly_dirs`)::
+
+		def configure(conf):
+			conf.check_assemblies('Eto Eto.Platform.Gtk', path_list=['libs', 'libs/Eto'])
+
+	:return: the list of the values returned by :py:func:`check_assembly`
+	"""
+	self.index_assembly_dirs(kw.get('path_list', []))
+	return [self.check_assembly(x, **dict(kw)) for x in Utils.to_list(names)]
+
+
+CS_PROBES = 'cs_probes.cache'
+
+def dir_stamp(path):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+@conf
+def probe_cache(self):
+	"""
+	The probes of the previous configurations, kept in the cache folder (c4che):
+
+	* ('probe', filename, folders) -> (folder modification times, path found or None)
+	* ('dir', folder) -> (modification time, names of the assemblies in the folder)
+	* ('pkg', command) -> (stamp of the .pc files, (exit code, output, errors))
+	* ('pc_path', pkg-config, modification time) -> default pkg-config search path
+	"""
+	try:
+		return self.cs_probes
+	except AttributeError:
+		try:
+			self.cs_probes = pickle.loads(Utils.readf(os.path.join(self.cachedir.abspath(), CS_PROBES), 'rb'))
+		except Exception:
+			self.cs_probes = {}
+		return self.cs_probes
+
+@conf
+def store_probe_cache(self):
+	db = os.path.join(self.cachedir.abspath(), CS_PROBES)
+	try:
+		Utils.writef(db + '.tmp', pickle.dumps(self.cs_probes, -1), 'wb')
+		try:
+			os.unlink(db)
+		except OSError:
+			pass
+		os.rename(db + '.tmp', db)
+	except (OSError, IOError):
+		Logs.warn('cs: could not store the configuration probes in %r' % db)
+
+def list_assembly_dir(args):
+	(path, cache) = args
+	stamp = dir_stamp(path)
+	try:
+		(k, names) = cache[('dir', path)]
+	except KeyError:
+		pass
+	else:
+		if k == stamp:
+			return (path, stamp, names, False)
+	try:
+		names = frozenset(x for x in os.listdir(path) if x.endswith('.dll'))
+	except OSError:
+		names = frozenset()
+	return (path, stamp, names, True)
+
+@conf
+def index_assembly_dirs(self, path_list):
+	"""
+	List the assembly folders in parallel, the next calls to :py:func:`check_assembly`
+	will look the assemblies up in the listings instead of probing the folders one file
+	at a time. The listings are reused by the next configurations while the
+	modification time of the folders does not change.
+
+	:param path_list: folders
+	:type path_list: list of string
+	"""
+	cache = self.probe_cache()
+	try:
+		index = self.cs_dir_index
+	except AttributeError:
+		index = self.cs_dir_index = {}
+
+	todo = []
+	for x in Utils.to_list(path_list):
+		if x:
+			x = os.path.abspath(os.path.expanduser(x))
+			if not x in index and not x in todo:
+				todo.append(x)
+	if not todo:
+		return
+
+	if len(todo) > 1:
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(min(len(todo), 8))
+		try:
+			lst = pool.map(list_assembly_dir, [(x, cache) for x in todo])
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		lst = [list_assembly_dir((todo[0], cache))]
+
+	dirty = False
+	for (path, stamp, names, listed) in lst:
+		index[path] = names
+		if listed:
+			cache[('dir', path)] = (stamp, names)
+			dirty = True
+		self.to_log('cs: %s %r' % (listed and 'listed' or 'cached listing of', path))
+	if dirty:
+		self.store_probe_cache()
+
+@conf
+def find_assembly(self, filename, path_list):
+	"""
+	Find an assembly in a list of folders, the result is cached in the cache folder and
+	reused while the modification times of the folders are the same. The folders indexed
+	by :py:func:`index_assembly_dirs` are not probed again.
+
+	:return: the path to the assembly, or None
+	"""
+	cache = self.probe_cache()
+	index = getattr(self, 'cs_dir_index', {})
+
+	paths = [os.path.abspath(os.path.expanduser(x)) for x in Utils.to_list(path_list)]
+	stamps = [dir_stamp(x) for x in paths]
+	key = ('probe', filename, tuple(paths))
+	try:
+		(k, ret) = cache[key]
+	except KeyError:
+		pass
+	else:
+		if k == stamps:
+			self.to_log('cs: cached probe for %r: %r' % (filename, ret))
+			return ret
+
+	ret = None
+	for x in paths:
+		try:
+			found = filename in index[x]
+		except KeyError:
+			found = os.path.exists(os.path.join(x, filename))
+		if found:
+			ret = os.path.join(x, filename)
+			break
+
+	cache[key] = (stamps, ret)
+	self.store_probe_cache()
+	return ret
+
+
 # Add define params to the compile command line
 @conf
 def set_define(self, *k):
@@ -428,57 +2350,174 @@ def set_sdk_version(self, sdk_version):
 
 
 # Simple Copy file Task
+@profile_task
 class copy_file(Task.Task):
+	"""
+	Copy a file, or link it when CS_COPY is 'hardlink', 'reflink' or 'symlink'. A plain
+	copy is made when the file system refuses the link, and nothing is done when the
+	destination is already the same file or has the same content.
+	"""
 	chmod = Utils.O644
 	inst_to = None
+	vars = ['CS_COPY']
 
 	def run(self):
 		infile = self.inputs[0].abspath()
 		outfile = self.outputs[0].abspath()
+		bld = self.generator.bld
 		try:
+			if same_file(infile, outfile):
+				cs_stat(bld, 'files already up to date')
+				return 0
+
+			mode = self.env.CS_COPY or 'copy'
+			if mode != 'copy' and link_file(mode, infile, outfile):
+				cs_stat(bld, 'files linked (%s)' % mode)
+				return 0
+
 			shutil.copy2(infile, outfile)
+			cs_stat(bld, 'files copied')
+			cs_stat(bld, 'bytes copied', os.path.getsize(outfile))
+			if self.chmod: os.chmod(outfile, self.chmod)
 		except (OSError, IOError):
 			return 1
+		return 0
+
+FICLONE = 0x40049409
+
+def link_file(mode, src, dst):
+	"""
+	Replace *dst* by a hard link, a reflink (copy-on-write clone) or a symbolic link to *src*
+
+	:return: False if the file system refused the link
+	"""
+	try:
+		os.remove(dst)
+	except OSError:
+		pass
+
+	try:
+		if mode == 'hardlink':
+			os.link(src, dst)
+		elif mode == 'symlink':
+			os.symlink(src, dst)
+		elif mode == 'reflink':
+			import fcntl
+			fs = open(src, 'rb')
+			try:
+				fd = open(dst, 'wb')
+				try:
+					fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+				finally:
+					fd.close()
+			finally:
+				fs.close()
+			shutil.copystat(src, dst)
 		else:
-			if self.chmod: os.chmod(outfile, self.chmod)
-			return 0
+			raise Errors.WafError('Invalid CS_COPY value %r' % mode)
+	except (ImportError, AttributeError, OSError, IOError):
+		try:
+			os.remove(dst)
+		except OSError:
+			pass
+		return False
+	return True
+
+def same_file(src, dst):
+	"""
+	Return True if *dst* is the same file as *src* (same inode) or has the same content
+	"""
+	try:
+		st1 = os.stat(src)
+		st2 = os.stat(dst)
+	except OSError:
+		return False
+
+	if (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino):
+		return True
+	if st1.st_size != st2.st_size:
+		return False
+
+	f1 = open(src, 'rb')
+	try:
+		f2 = open(dst, 'rb')
+		try:
+			while True:
+				b1 = f1.read(1048576)
+				if b1 != f2.read(1048576):
+					return False
+				if not b1:
+					return True
+		finally:
+			f2.close()
+	finally:
+		f1.close()
 
 
 # Copy all external (USE) library in the the build directory. This will allow use to
 # run the codes from within that build directory.
+#
+# With the 'shared' layout (configure --cs-dev-layout=shared or dev_layout='shared' on the
+# task generator) the libraries are staged once in a single directory per variant
+# (CS_DEV_DIR, 'runtime' by default) next to the programs using them, instead of once per program.
 @feature('cs_dev')
 @after('use_cs')
 def copy_dependent_library(self):
-	names = self.to_list(getattr(self, 'use', []))
-
-	for x in names:
-		uselib = x.upper()
-
-		pkg = getattr(self.env, 'PKG_' + uselib, [])
-		if len(pkg):
+	dest = None
+	if getattr(self, 'dev_layout', self.env.CS_DEV_LAYOUT) == 'shared':
+		dest = self.bld.bldnode.make_node(self.env.CS_DEV_DIR or 'runtime')
+		tsk = getattr(self, 'cs_task', None)
+		if tsk:
+			for x in tsk.outputs:
+				copy_lib(self, x, dest)
+		for tsk in getattr(self, 'cs_module_tasks', []):
+			copy_lib(self, tsk.outputs[0], dest)
+
+	for x in self.cs_references():
+		if x.kind in ('package', 'framework') or not x.node:
 			continue
 
-		try:
-			tg = self.bld.get_tgen_by_name(x)
-			tg.post()
-			tsk = getattr(tg, 'cs_task', None) or getattr(tg, 'link_task', None)
-			lib = tsk.outputs[0]
-		except Errors.WafError:
-			csflags = getattr(self.env, 'CSFLAGS_' + uselib, [])
-			if len(csflags) == 0:
-				continue
-			lib = self.bld.root.find_node(csflags[0][3:])
-
-		copy_lib(self, lib)
-		copy_config(self, lib)
+		copy_lib(self, x.node, dest)
+		copy_config(self, x.node, dest)
+		# the netmodules of a multi-file assembly, see apply_cs_modules
+		for tsk in getattr(x.tg, 'cs_module_tasks', []):
+			copy_lib(self, tsk.outputs[0], dest)
 
-def copy_lib(tgen, target):
-	out = tgen.path.find_or_declare(target.name)
-	tgen.copy_dependent_lib_task = tgen.create_task('copy_file', target, out)
+def copy_lib(tgen, target, dest=None):
+	out = stage_node(tgen, target, dest)
+	if out:
+		tgen.copy_dependent_lib_task = tgen.create_task('copy_file', target, out)
 
-def copy_config(tgen, target):
+def copy_config(tgen, target, dest=None):
 	config = target.change_ext('.dll.config');
 	if os.path.isfile(config.abspath()):
-		out = tgen.path.find_or_declare(config.name)
-		tgen.copy_dependent_lib_config_task = tgen.create_task('copy_file', config, out)
+		out = stage_node(tgen, config, dest)
+		if out:
+			tgen.copy_dependent_lib_config_task = tgen.create_task('copy_file', config, out)
 
+def stage_node(tgen, target, dest):
+	"""
+	Return the node *target* is copied to, or None if another task generator already
+	staged it in the shared directory *dest*
+	"""
+	if dest is None:
+		# next to the assembly (target='t/A.Tests.dll'), the programs and the tests run in its folder
+		tsk = getattr(tgen, 'cs_task', None)
+		out = (tsk and tsk.outputs[0].parent or tgen.path).find_or_declare(target.name)
+		if out is target:
+			# same directory, nothing to copy
+			return None
+		return out
+
+	out = dest.find_or_declare(target.name)
+	try:
+		staged = tgen.bld.cs_dev_staged
+	except AttributeError:
+		staged = tgen.bld.cs_dev_staged = {}
+
+	if out in staged:
+		if staged[out] is not target:
+			tgen.bld.fatal('%r and %r are both staged as %r' % (staged[out], target, out))
+		return None
+	staged[out] = target
+	return out
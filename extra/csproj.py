@@ -10,13 +10,20 @@ Visual Studio csproj file support. A simple example::
     def csproj(ctx):
         ctx(features='csproj', source='main.cs', target='sample.csproj', template='template.csproj' use='gtk-sharp')
 
+*waf msbuild* also writes the solution file APPNAME.sln in the top directory
+(or bld.SolutionFile) with the build dependencies between the projects.
 """
 
-import os, uuid, sys
+import os, uuid, sys, io
 import xml.etree.ElementTree as XML
 from hashlib import md5
 
-from waflib import Utils, Task, Build, Options, Logs, Errors, Scripting, TaskGen, Context
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from waflib import Utils, Task, Build, Options, Logs, Errors, Scripting, TaskGen, Context, Node
 
 DEFAULT_CSPROJ_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
 <Project DefaultTargets="Build" xmlns="http://schemas.microsoft.com/developer/msbuild/2003" ToolsVersion="4.0">
@@ -69,6 +76,65 @@ def make_uuid(k):
     return '{%s}' % str(guid).upper()
 
 
+def toposort(nodes, deps):
+    """
+    Sort the nodes so that each one comes after its dependencies, keeping the
+    declaration order otherwise
+
+    :param deps: dict node -> list of nodes it depends on
+    """
+    count = dict((x, len(deps[x])) for x in nodes)
+    users = dict((x, []) for x in nodes)
+    for x in nodes:
+        for y in deps[x]:
+            users[y].append(x)
+
+    ready = [x for x in nodes if not count[x]]
+    ret = []
+    while ready:
+        x = ready.pop(0)
+        ret.append(x)
+        for y in users[x]:
+            count[y] -= 1
+            if not count[y]:
+                ready.append(y)
+
+    if len(ret) != len(nodes):
+        raise Errors.WafError('Cycle detected in the use graph: %r' % [x.name for x in nodes if not x in ret])
+    return ret
+
+def render_sln(projects):
+    """
+    Return the content of a solution file
+
+    :param projects: list of tuples (name, path, guid, [dependency guids]) in build order
+    """
+    lines = ['', 'Microsoft Visual Studio Solution File, Format Version 11.00', '# Visual Studio 2010']
+    for (name, path, guid, deps) in projects:
+        lines.append('Project("%s") = "%s", "%s", "%s"' % (CSPROJ_TYPE_GUID, name, path, guid))
+        if deps:
+            lines.append('\tProjectSection(ProjectDependencies) = postProject')
+            for x in deps:
+                lines.append('\t\t%s = %s' % (x, x))
+            lines.append('\tEndProjectSection')
+        lines.append('EndProject')
+
+    lines.append('Global')
+    lines.append('\tGlobalSection(SolutionConfigurationPlatforms) = preSolution')
+    for cfg in SLN_CONFIGURATIONS:
+        lines.append('\t\t%s = %s' % (cfg, cfg))
+    lines.append('\tEndGlobalSection')
+    lines.append('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution')
+    for (name, path, guid, deps) in projects:
+        for cfg in SLN_CONFIGURATIONS:
+            lines.append('\t\t%s.%s.ActiveCfg = %s' % (guid, cfg, cfg))
+            lines.append('\t\t%s.%s.Build.0 = %s' % (guid, cfg, cfg))
+    lines.append('\tEndGlobalSection')
+    lines.append('EndGlobal')
+    lines.append('')
+    return '\r\n'.join(lines)
+
+
 @TaskGen.taskgen_method
 def csproj_name(self):
     return strip_ext(self.name)
@@ -84,6 +150,15 @@ def project_guid(self):
     return make_uuid(self.name)
 
 
+CSPROJ_SIGS = '.csproj_sigs'
+CSPROJ_SLN = '.csproj_sln'
+
+CSPROJ_TYPE_GUID = '{FAE04EC0-301F-11D3-BF4B-00C04F79EFBC}'
+SLN_CONFIGURATIONS = ['Debug|Any CPU', 'Release|Any CPU']
+
+# below this number of projects, the csproj files are written without a pool of workers
+CSPROJ_POOL_MIN = 16
+
 class MSBuildContext(Build.BuildContext):
 
 
@@ -101,29 +176,214 @@ class MSBuildContext(Build.BuildContext):
         self.recurse([self.run_dir])
 
         self.create_csproj_files()
+        self.create_sln_file()
 
     def create_csproj_files(self):
         """
         Create a csproj file for each task_gen with a cs_task.
+
+        The task generators whose inputs did not change since the last run are not
+        posted, and a csproj file is only written when its content changed, so
+        Visual Studio and MSBuild do not reload the projects for nothing.
         """
+        self.load_csproj_sigs()
+        projects = []
+        unchanged = 0
 
         for g in self.groups:
             for tg in g:
                 if not isinstance(tg, TaskGen.task_gen):
                     continue
 
+                if not 'cs' in Utils.to_list(getattr(tg, 'features', [])):
+                    continue
+
+                path = tg.csproj_path().abspath()
+                sig = self.csproj_signature(tg)
+                if self.csproj_sigs.get(path) == sig and os.path.isfile(path):
+                    unchanged += 1
+                    continue
+
                 tg.post()
                 if not getattr(tg, 'cs_task', None):
                     continue
 
                 csproj = CSProjectBuilder(self, tg)
                 csproj.add_properties(getattr(tg, 'PropertyGroup', {}))
-                csproj.write()
+                projects.append(csproj.collect())
+                self.csproj_sigs[path] = sig
 
+        ret = self.write_csproj_files(projects)
+        written = ret.count(True)
+        unchanged += ret.count(False)
 
-class CSProjectBuilder(object):
+        self.store_csproj_sigs()
+        Logs.debug('csproj: %d project files written, %d unchanged' % (written, unchanged))
 
-    xml_namespace = 'http://schemas.microsoft.com/developer/msbuild/2003'
+    def write_csproj_files(self, projects):
+        """
+        Render and write the csproj files. On large solutions the work is spread over
+        a pool of *-j* processes (threads on platforms without fork), the task
+        generators are still posted on the main thread.
+
+        :return: a list of booleans telling which files were written
+        """
+        jobs = min(Options.options.jobs, len(projects))
+        if jobs < 2 or len(projects) < CSPROJ_POOL_MIN:
+            return [write_csproj(x) for x in projects]
+
+        if hasattr(os, 'fork'):
+            from multiprocessing import Pool
+        else:
+            from multiprocessing.pool import ThreadPool as Pool
+
+        pool = Pool(jobs)
+        try:
+            return pool.map(write_csproj, projects)
+        finally:
+            pool.close()
+            pool.join()
+
+    def csproj_signature(self, tg):
+        """
+        Hash the inputs of the csproj file of a task generator without posting it:
+        the sources, the references, the properties and the template.
+        """
+        env = self.env
+        lst = [self.get_csproj_template_sig()]
+        for x in ('PropertyGroup', 'ToolsVersion', 'CSDEBUG'):
+            lst.append(env[x])
+
+        for x in ('name', 'target', 'bintype', 'platform', 'csdebug', 'PropertyGroup', 'resources'):
+            lst.append(getattr(tg, x, None))
+        lst.append(tg.path.abspath())
+
+        sources = list(tg.to_list(getattr(tg, 'source', [])))
+        for m in getattr(tg, 'cs_modules', []):
+            sources.extend(tg.to_list(m['source']))
+        for x in sources:
+            lst.append(isinstance(x, Node.Node) and x.abspath() or x)
+
+        # the references are transitive, see cs_references
+        seen = set()
+        stack = [tg]
+        while stack:
+            for x in Utils.to_list(getattr(stack.pop(), 'use', [])):
+                if x in seen:
+                    continue
+                seen.add(x)
+                uselib = x.upper()
+                lst.append((x, env['CSFLAGS_' + uselib], env['PKG_' + uselib]))
+                try:
+                    y = self.get_tgen_by_name(x)
+                except Errors.WafError:
+                    continue
+                lst.append((y.name, getattr(y, 'target', None), y.path.abspath()))
+                stack.append(y)
+
+        return md5(repr(lst).encode()).hexdigest()
+
+    def get_csproj_template_sig(self):
+        try:
+            return self.csproj_template_sig
+        except AttributeError:
+            tpl = getattr(self, 'CSProjTemplate', None)
+            self.csproj_template_sig = (tpl and Utils.h_file(tpl)) or DEFAULT_CSPROJ_TEMPLATE
+            return self.csproj_template_sig
+
+    def load_csproj_sigs(self):
+        self.csproj_sigs = self.read_cache(CSPROJ_SIGS) or {}
+
+    def store_csproj_sigs(self):
+        self.write_cache(CSPROJ_SIGS, self.csproj_sigs)
+
+    def read_cache(self, name):
+        try:
+            return pickle.loads(Utils.readf(os.path.join(self.variant_dir, name), 'rb'))
+        except Exception:
+            return None
+
+    def write_cache(self, name, data):
+        db = os.path.join(self.variant_dir, name)
+        try:
+            Utils.writef(db, pickle.dumps(data, -1), 'wb')
+        except (OSError, IOError):
+            Logs.warn('csproj: could not write %r' % db)
+
+    def pre_recurse(self, node):
+        Build.BuildContext.pre_recurse(self, node)
+        try:
+            self.wscript_nodes.append(node)
+        except AttributeError:
+            self.wscript_nodes = [node]
+
+    def get_sln_path(self):
+        sln = getattr(self, 'SolutionFile', None)
+        if sln:
+            return self.srcnode.make_node(sln)
+        return self.srcnode.make_node('%s.sln' % getattr(Context.g_module, 'APPNAME', 'noname'))
+
+    def create_sln_file(self):
+        """
+        Create a solution file listing the csproj files in the build order of the *use*
+        graph, with their dependencies, so that *msbuild /m* can schedule the projects
+        without discovering the project references first.
+
+        The graph is cached and only computed again when a wscript file or the
+        configuration changed.
+        """
+        node = self.get_sln_path()
+        sig = Utils.h_list([node.abspath()] + [Utils.h_file(x.abspath()) for x in getattr(self, 'wscript_nodes', [])] +
+            [(k, sorted(v.get_merged_dict().items())) for (k, v) in sorted(self.all_envs.items())])
+
+        cache = self.read_cache(CSPROJ_SLN)
+        if cache and cache[0] == sig:
+            projects = cache[1]
+        else:
+            projects = self.get_sln_projects(node.parent)
+            self.write_cache(CSPROJ_SLN, (sig, projects))
+
+        data = render_sln(projects).encode('utf-8')
+        try:
+            if Utils.readf(node.abspath(), 'rb') == data:
+                return
+        except (OSError, IOError):
+            pass
+        Utils.writef(node.abspath(), data, 'wb')
+
+    def get_sln_projects(self, sln_dir):
+        """
+        Return the projects of the solution sorted in build order (dependencies first),
+        as a list of tuples (name, path, guid, [dependency guids])
+        """
+        tgs = []
+        for g in self.groups:
+            for tg in g:
+                if isinstance(tg, TaskGen.task_gen) and 'cs' in Utils.to_list(getattr(tg, 'features', [])):
+                    tgs.append(tg)
+
+        deps = dict((tg, []) for tg in tgs)
+        for tg in tgs:
+            for x in Utils.to_list(getattr(tg, 'use', [])):
+                try:
+                    y = self.get_tgen_by_name(x)
+                except Errors.WafError:
+                    continue
+                if y in deps:
+                    deps[tg].append(y)
+
+        ret = []
+        for tg in toposort(tgs, deps):
+            path = tg.csproj_path().path_from(sln_dir).replace('/', '\\')
+            ret.append((tg.csproj_name(), path, tg.project_guid(), [y.project_guid() for y in deps[tg]]))
+        return ret
+
+class CSProjectBuilder(object):
+    """
+    Collect what the csproj file of a task generator contains. The result of
+    :py:meth:`collect` is plain data, the xml is produced by :py:class:`CSProjectRenderer`
+    which may run in another thread or process.
+    """
 
     def __init__(self, bld, tg):
         self.bld = bld
@@ -139,9 +399,6 @@ class CSProjectBuilder(object):
         self.src_dir = tg.path
         self.bld_dir = tg.path.get_bld()
 
-        # new to create the solution file here
-        XML.register_namespace('', self.xml_namespace);
-
         for prop in getattr(self.env, 'PropertyGroup', []):
             try:
                 k, v = prop.split('=', 2)
@@ -164,56 +421,46 @@ class CSProjectBuilder(object):
     def get_path(self):
         return self.tg.csproj_path()
 
-    def write(self):
+    def collect(self):
+        """
+        Return the content of the csproj file as a dict of strings and lists
+        """
         self.group_dependent_assembly()
         self.get_property_from_tg(self.tg)
 
-        project = XML.fromstring(self.get_project_xmlstr())
-
-        self.set_tools_version(project)
-        self.write_property_group(project)
-        self.write_source(project)
-        self.write_embeddedresources(project)
-        self.write_reference(project)
-
-        indent(project)
-        csproj = XML.ElementTree(project)
-        csproj.write(self.get_path().abspath(), xml_declaration=True, encoding='utf-8')
+        return {
+            'path': self.get_path().abspath(),
+            'template': self.get_project_xmlstr(),
+            'tools_version': getattr(self.env, 'ToolsVersion', None),
+            'properties': self.properties,
+            'sources': self.get_sources(),
+            'resources': self.get_embeddedresources(),
+            'dotnet_refs': self.dotnet_refs,
+            'external_refs': self.get_ext_refs(),
+            'projects': self.get_projects(),
+        }
+
+    def render(self):
+        return CSProjectRenderer(self.collect()).render()
 
-
-    def set_tools_version(self, project):
-        tools_version = getattr(self.env, 'ToolsVersion', None)
-        if tools_version:
-            project.set('ToolsVersion', str(tools_version))
+    def write(self):
+        return CSProjectRenderer(self.collect()).write()
 
 
     def group_dependent_assembly(self):
         '''
         cycle over all dependencies and sort them into types
         '''
-        get = self.bld.get_tgen_by_name
-        env = self.env
-        for x in Utils.to_list(getattr(self.tg, 'use', [])):
-            uselib = x.upper()
-            csflags = getattr(env, 'CSFLAGS_' + uselib, None)
-            if csflags:
-                pkg = getattr(env, 'PKG_' + uselib, None)
-
-                for ref in Utils.to_list(csflags):
-                    self.external_refs.append({"reference": ref[3:], "package": pkg})
-
-                continue
-
-            try:
-                y = get(x)
-            except Errors.WafError:
-                self.dotnet_refs.append(x)
-                continue
-
-            y.post()
-            tsk = getattr(y, 'cs_task', None) or getattr(y, 'link_task', None)
-            if tsk:
-                self.projects.append(y)
+        for x in self.tg.cs_references():
+            if len(x.flags):
+                for ref in x.flags:
+                    self.external_refs.append({"reference": ref[3:], "package": x.package})
+            elif x.kind == 'project':
+                self.projects.append(x.tg)
+            elif x.node:
+                self.external_refs.append({"reference": x.node.abspath(), "package": None})
+            else:
+                self.dotnet_refs.append(x.name)
 
 
     def get_property_from_tg(self, tg):
@@ -226,12 +473,92 @@ class CSProjectBuilder(object):
         pg['Platform'] = getattr(tg, 'platform', 'anycpu')
         pg['Configuration'] = 'Debug' if getattr(tg, 'csdebug', self.env.CSDEBUG) else 'Release'
 
+    def get_sources(self):
+        tg = self.tg
+        # the sources of the netmodules are compiled in the same assembly
+        tasks = [tg.cs_task] + getattr(tg, 'cs_module_tasks', [])
+        return [s.path_from(tg.path) for t in tasks for s in t.inputs]
+
+
+    def get_ext_refs(self):
+        lst = []
+        for ref in self.external_refs:
+            lib_path = self.bld.root.find_or_declare(ref['reference']);
+            lst.append((lib_path.name, lib_path.path_from(self.src_dir), not ref['package']))
+        return lst
+
+    def get_embeddedresources(self):
+        lst = []
+        for res in getattr(self.tg, 'resources', []):
+            (path, link) = res.split(',', 2)
+            nod = self.bld.root.find_resource(path)
+            if nod:
+                lst.append((nod.path_from(self.src_dir), link))
+        return lst
+
+
+    def get_projects(self):
+        return [(ref.csproj_path().path_from(self.src_dir), ref.project_guid(), ref.csproj_name()) for ref in self.projects]
+
+
+class CSProjectRenderer(object):
+    """
+    Produce the xml of a csproj file from the data returned by :py:meth:`CSProjectBuilder.collect`
+    """
+
+    xml_namespace = 'http://schemas.microsoft.com/developer/msbuild/2003'
+
+    def __init__(self, data):
+        self.data = data
+
+        # new to create the solution file here
+        XML.register_namespace('', self.xml_namespace);
+
+    def render(self):
+        """
+        Return the content of the csproj file
+        """
+        project = XML.fromstring(self.data['template'])
+
+        self.set_tools_version(project)
+        self.write_property_group(project)
+        self.write_source(project)
+        self.write_embeddedresources(project)
+        self.write_reference(project)
+
+        indent(project)
+        csproj = XML.ElementTree(project)
+        buf = io.BytesIO()
+        csproj.write(buf, xml_declaration=True, encoding='utf-8')
+        return buf.getvalue()
+
+    def write(self):
+        """
+        Write the csproj file if its content changed, return True if the file was written
+        """
+        data = self.render()
+        path = self.data['path']
+        try:
+            if Utils.readf(path, 'rb') == data:
+                return False
+        except (OSError, IOError):
+            pass
+
+        Utils.writef(path, data, 'wb')
+        return True
+
+
+    def set_tools_version(self, project):
+        tools_version = self.data['tools_version']
+        if tools_version:
+            project.set('ToolsVersion', str(tools_version))
+
+
     def write_source(self, project):
         item_group = XML.Element('ItemGroup', {'Label': 'Source'})
-        tg = self.tg
 
-        for s in tg.cs_task.inputs:
-            e = XML.Element('Compile', {'Include': s.path_from(tg.path)})
+        for s in self.data['sources']:
+            e = XML.Element('Compile', {'Include': s})
             item_group.append(e)
 
         project.insert(len(project) - 1, item_group)
@@ -244,7 +571,7 @@ class CSProjectBuilder(object):
             property_group = XML.Element('PropertyGroup')
             project.insert(1, property_group)
 
-        for k, v in self.properties.items():
+        for k, v in self.data['properties'].items():
             p = self.get_property_element(property_group, k)
             p.text = v
 
@@ -272,22 +599,19 @@ class CSProjectBuilder(object):
 
 
     def write_dotnet_refs(self, item_group):
-        for ref in self.dotnet_refs:
+        for ref in self.data['dotnet_refs']:
             el = XML.SubElement(item_group, 'Reference')
             el.set('Include', ref)
 
 
     def write_ext_refs(self, item_group):
-        for ref in self.external_refs:
-
-            lib_path = self.bld.root.find_or_declare(ref['reference']);
-
+        for (name, hintpath, private) in self.data['external_refs']:
             ref_el = XML.SubElement(item_group, 'Reference')
-            ref_el.set('Include', lib_path.name);
+            ref_el.set('Include', name);
             hintpath_el = XML.SubElement(ref_el, 'HintPath')
-            hintpath_el.text = lib_path.path_from(self.src_dir);
+            hintpath_el.text = hintpath;
             private_el = XML.SubElement(ref_el, 'Private')
-            private_el.text = 'true' if not ref['package'] else 'false'
+            private_el.text = 'true' if private else 'false'
 
     def write_embeddedresources(self, project):
         '''
@@ -298,28 +622,33 @@ class CSProjectBuilder(object):
         </ItemGroup>
         '''
 
-        resources = getattr(self.tg, 'resources', []);
+        resources = self.data['resources']
         if len(resources):
             item_group = XML.Element('ItemGroup', {'Label': 'EmbeddedResource'})
-            for res in resources:
-                (path, link) = res.split(',', 2)
-                nod = self.bld.root.find_resource(path)
-                if nod:
-                    res_el = XML.Element('EmbeddedResource', {'Include': nod.path_from(self.src_dir)})
-                    if len(link):
-                        link_el = XML.SubElement(res_el, 'Link')
-                        link_el.text = link
+            for (path, link) in resources:
+                res_el = XML.Element('EmbeddedResource', {'Include': path})
+                if len(link):
+                    link_el = XML.SubElement(res_el, 'Link')
+                    link_el.text = link
 
-                    item_group.append(res_el)
+                item_group.append(res_el)
 
             project.insert(len(project) - 1, item_group)
 
 
     def write_project(self, item_group):
-        for ref in self.projects:
+        for (path, guid, name) in self.data['projects']:
             pref_el = XML.SubElement(item_group, 'ProjectReference')
-            pref_el.set('Include', ref.csproj_path().path_from(self.src_dir))
+            pref_el.set('Include', path)
             project_el = XML.SubElement(pref_el, 'Project')
-            project_el.text = '{%s}' % ref.project_guid()
+            project_el.text = '{%s}' % guid
             name_el = XML.SubElement(pref_el, 'Name')
-            name_el.text = ref.csproj_name()
+            name_el.text = name
+
+
+def write_csproj(data):
+    """
+    Write a csproj file from the data collected by :py:meth:`CSProjectBuilder.collect`,
+    module function so that it can be handed to a process pool
+    """
+    return CSProjectRenderer(data).write()
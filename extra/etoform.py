@@ -40,8 +40,10 @@ def check_etoform(self, *k, **kw):
 
     uselib_etoplatform = 'Eto.Platform'
 
-    self.check_assembly('Eto', path_list = [x for x in etoform_dir if x is not None])
-    self.check_assembly(platform, path_list = [x for x in etoform_dir if x is not None], uselib_store=uselib_etoplatform)
+    etoform_dir = [x for x in etoform_dir if x is not None]
+    self.index_assembly_dirs(etoform_dir)
+    self.check_assembly('Eto', path_list = etoform_dir)
+    self.check_assembly(platform, path_list = etoform_dir, uselib_store=uselib_etoplatform)
 
 
 @conf
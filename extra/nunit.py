@@ -2,13 +2,432 @@
 # encoding: utf-8
 # Copyright © 2012 SjB <steve@nca.uwo.ca>. All Rights Reserved.
 
+"""
+Run the NUnit tests of the C# libraries::
+
+    def options(opt):
+        opt.load('cs nunit', tooldir='extra')
+    def configure(conf):
+        conf.load('cs nunit', tooldir='extra')
+        conf.check_nunit()
+    def build(bld):
+        bld(features='cs', source='LibTests.cs', target='Lib.Tests.dll', use='Lib nunit.framework')
+
+    $ waf nunit -j8
+
+The test assemblies are the libraries using nunit (or having the attribute *nunit=True*),
+each one is run by nunit-console in a waf task, with the libraries it uses staged next
+to it (see copy_dependent_library). The durations of the fixtures are kept in
+build/nunit_times.json: the next runs split the large assemblies in shards of fixtures
+(at most one per job, of --nunit-shard-time seconds at least) balanced on these durations,
+and the longest shards are started first.
+
+The results of all the shards are merged in build/nunit/TestResult.xml, the command
+fails if a test failed.
+
+A test assembly which passed is not run again while the assembly and the assemblies it
+uses (directly or not) are the same, its previous results are reported instead, see
+:py:func:`nunit_test_key`. Use *waf nunit --force-tests* to run all the tests.
+"""
+
+import json, heapq, os
+import xml.etree.ElementTree as XML
+from waflib import Build, Logs, Options, Task, TaskGen, Utils
 from waflib.Configure import conf
+from waflib.TaskGen import after, feature
+
+from cs import h_assembly
+
+NUNIT_TIMES = 'nunit_times.json'
+NUNIT_DIR = 'nunit'
+
+# counters of the <test-results> element
+RESULT_COUNTS = ('total', 'errors', 'failures', 'not-run', 'inconclusive', 'ignored', 'skipped', 'invalid')
+# the worst result of the children is the result of a test suite
+RESULT_RANK = {'Success': 0, 'Inconclusive': 1, 'Ignored': 2, 'Skipped': 2, 'NotRunnable': 3, 'Failure': 4, 'Error': 5, 'Cancelled': 6}
+FIXTURE_TYPES = ('TestFixture', 'ParameterizedFixture', 'GenericFixture')
+
+def options(opt):
+    opt.add_option('--nunit-shard-time', type='float', dest='nunit_shard_time', default=10.0,
+        help='Minimum duration of a shard of fixtures run by waf nunit, in seconds [default: 10]')
+    opt.add_option('--force-tests', dest='force_tests', action='store_true', default=False,
+        help='Run the tests which passed with the same assemblies too')
 
 @conf
 def check_nunit(self, nunit_name = 'nunit-console'):
     self.find_program(nunit_name, var='NUNIT')
+    self.env.NUNITFLAGS = ['-nologo']
 
-from waflib.Build import BuildContext
-class NUnitContext(BuildContext):
+class NUnitContext(Build.BuildContext):
+    '''runs the nunit tests of the C# libraries'''
     cmd = 'nunit'
     fun = 'build'
+
+def is_test_assembly(tg):
+    """
+    A library using nunit is a test assembly, unless its attribute *nunit* is False
+    """
+    val = getattr(tg, 'nunit', None)
+    if val is not None:
+        return val
+    tsk = getattr(tg, 'cs_task', None)
+    if not tsk or tsk.env.CSTYPE != '/target:library':
+        return False
+    for x in tg.cs_references(transitive=False):
+        if x.name.lower().startswith('nunit'):
+            return True
+    return False
+
+@feature('cs')
+@after('apply_cs', 'use_cs', 'apply_cs_modules', 'copy_dependent_library')
+def make_nunit(self):
+    """
+    Create the nunit tasks of a test assembly, for the nunit command only
+    """
+    if not isinstance(self.bld, NUnitContext) or not is_test_assembly(self):
+        return
+
+    if not 'cs_dev' in self.features:
+        self.copy_dependent_library()
+
+    node = self.cs_task.outputs[0]
+    if getattr(self, 'dev_layout', self.env.CS_DEV_LAYOUT) == 'shared':
+        node = self.bld.bldnode.make_node(self.env.CS_DEV_DIR or 'runtime').find_or_declare(node.name)
+
+    if not hasattr(self.bld, 'nunit_results'):
+        self.bld.nunit_results = []
+        self.bld.add_post_fun(nunit_report)
+
+    key = node.bldpath()
+    shards = nunit_shards(self.bld, key)
+    for (i, (duration, fixtures)) in enumerate(shards):
+        tsk = self.create_task('nunit', node)
+        tsk.assembly = key
+        tsk.shard = i
+        tsk.fixtures = len(shards) > 1 and sorted(fixtures) or None
+        tsk.xml = self.bld.bldnode.make_node([NUNIT_DIR, '%s.%d.xml' % (result_name(key), i)])
+        tsk.cs_priority = duration # the longest shards first, see cs.task_priority
+
+        # the references are staged by the tasks of this task generator and, in the
+        # shared layout, by the task generators of the references
+        for tg in [self] + [x.tg for x in self.cs_references() if x.tg]:
+            for x in tg.tasks:
+                if not isinstance(x, nunit):
+                    tsk.set_run_after(x)
+
+@TaskGen.taskgen_method
+def nunit_key(self):
+    """
+    Hash of the sources of a test assembly: the fixtures recorded for the same sources
+    are the fixtures of the assembly, whatever the libraries it uses
+    """
+    m = Utils.md5()
+    for tsk in [self.cs_task] + getattr(self, 'cs_module_tasks', []):
+        for x in tsk.inputs:
+            m.update(x.get_bld_sig())
+    return Utils.to_hex(m.digest())
+
+@TaskGen.taskgen_method
+def nunit_test_key(self, node):
+    """
+    Hash of the test assembly *node* and of the assemblies it uses, directly or not (the
+    references of :py:func:`cs.use_cs`): the results of the tests cannot change while the
+    key is the same. The pkg-config packages are keyed on their flags only. The assemblies
+    of the C# projects change at each build unless they are compiled in deterministic mode.
+    """
+    try:
+        return self.nunit_test_key_value
+    except AttributeError:
+        pass
+
+    bld = self.bld
+    m = Utils.md5()
+    m.update(bld.hash_env_vars(self.env, nunit.vars))
+    nodes = [node] + [x.outputs[0] for x in getattr(self, 'cs_module_tasks', [])]
+    for x in self.cs_references():
+        m.update(('%s %s %s' % (x.kind, x.name, ' '.join(x.flags))).encode())
+        if x.node:
+            nodes.append(x.node)
+        if x.tg:
+            nodes.extend(t.outputs[0] for t in getattr(x.tg, 'cs_module_tasks', []))
+    for x in nodes:
+        m.update(h_assembly(bld, x))
+    self.nunit_test_key_value = Utils.to_hex(m.digest())
+    return self.nunit_test_key_value
+
+@TaskGen.taskgen_method
+def nunit_cached(self, tsk):
+    """
+    Return the file holding the results of the previous run if the test assembly passed
+    with the same key, else None
+    """
+    try:
+        return self.nunit_cached_xml
+    except AttributeError:
+        pass
+
+    self.nunit_cached_xml = None
+    if not getattr(Options.options, 'force_tests', False):
+        key = self.nunit_test_key(tsk.inputs[0])
+        xml = passed_xml(self.bld, tsk.assembly)
+        if load_times(self.bld).get(tsk.assembly, {}).get('passed') == key and os.path.isfile(xml):
+            self.nunit_cached_xml = xml
+            self.bld.nunit_results.append({'assembly': tsk.assembly, 'xml': xml, 'cached': True})
+    return self.nunit_cached_xml
+
+def result_name(key):
+    return key.replace('/', '.').replace(os.sep, '.')
+
+def passed_xml(bld, key):
+    return os.path.join(bld.bldnode.abspath(), NUNIT_DIR, '%s.passed.xml' % result_name(key))
+
+def load_times(bld):
+    try:
+        return bld.nunit_times
+    except AttributeError:
+        try:
+            bld.nunit_times = json.loads(Utils.readf(os.path.join(bld.variant_dir, NUNIT_TIMES)))
+        except (OSError, IOError, ValueError):
+            bld.nunit_times = {}
+        return bld.nunit_times
+
+def nunit_shards(bld, key):
+    """
+    Split the fixtures recorded for a test assembly in shards of about the same duration
+    (longest processing time first)
+
+    :return: a list of (duration, fixture names), one shard with no fixtures to run the
+        whole assembly
+    """
+    times = load_times(bld)
+    fixtures = times.get(key, {}).get('fixtures', {})
+    total = sum(fixtures.values())
+    if not fixtures:
+        # never run: start with the longest known assembly
+        return [(max([sum(x['fixtures'].values()) for x in times.values()] or [0.0]), [])]
+
+    shard_time = max(getattr(Options.options, 'nunit_shard_time', 10.0), 0.001)
+    count = min(bld.jobs, len(fixtures), max(1, int(total // shard_time)))
+    if count < 2:
+        return [(total, [])]
+
+    heap = [(0.0, i, []) for i in range(count)]
+    for (name, duration) in sorted(fixtures.items(), key=lambda x: (-x[1], x[0])):
+        (load, i, lst) = heapq.heappop(heap)
+        lst.append(name)
+        heapq.heappush(heap, (load + duration, i, lst))
+    heap.sort(key=lambda x: x[1])
+    return [(load, lst) for (load, i, lst) in heap]
+
+class nunit(Task.Task):
+    """
+    Run the tests of an assembly, or of a shard of its fixtures (nunit-console -run).
+    The failed tests do not stop the build, they are reported with the merged results
+    by :py:func:`nunit_report`
+    """
+    color = 'PINK'
+    vars = ['NUNIT', 'NUNITFLAGS']
+
+    def __str__(self):
+        ret = Task.Task.__str__(self)
+        if self.fixtures:
+            ret = '%s (%d fixtures)\n' % (ret.rstrip('\n'), len(self.fixtures))
+        return ret
+
+    def runnable_status(self):
+        ret = Task.Task.runnable_status(self)
+        if ret == Task.ASK_LATER:
+            return ret
+        if self.generator.nunit_cached(self):
+            return Task.SKIP_ME
+        # the tests run every time otherwise
+        return Task.RUN_ME
+
+    def run(self):
+        bld = self.generator.bld
+        key = self.generator.nunit_key()
+        fixtures = self.fixtures
+        if fixtures and load_times(bld).get(self.assembly, {}).get('key') != key:
+            # the sources changed, there may be new fixtures: the first shard runs them all
+            if self.shard:
+                return 0
+            fixtures = None
+
+        xml = self.xml.abspath()
+        self.xml.parent.mkdir()
+        if os.path.exists(xml):
+            os.remove(xml)
+
+        node = self.inputs[0]
+        cmd = Utils.to_list(self.env.NUNIT) + Utils.to_list(self.env.NUNITFLAGS) + [node.abspath(), '-xml=%s' % xml]
+        if fixtures:
+            cmd.append('-run=%s' % ','.join(fixtures))
+        ret = self.exec_command(cmd, cwd=node.parent.abspath())
+
+        # nunit-console returns the number of failures, there are no results on errors
+        if not os.path.isfile(xml):
+            Logs.error('nunit: no test results for %s' % node.abspath())
+            return ret or 1
+        bld.nunit_results.append({'assembly': self.assembly, 'key': key, 'xml': xml,
+            'test_key': self.generator.nunit_test_key(node)})
+        return 0
+
+def read_fixtures(path):
+    """
+    Read the durations of the fixtures from a NUnit result file
+
+    :return: a dict mapping the full names of the fixtures to their durations in seconds
+    """
+    ret = {}
+    def walk(suite, names):
+        typ = suite.get('type')
+        if not typ in ('Assembly', 'Test Project'):
+            names = names + [suite.get('name')]
+        if typ in FIXTURE_TYPES:
+            try:
+                ret['.'.join(names)] = float(suite.get('time') or 0)
+            except ValueError:
+                ret['.'.join(names)] = 0.0
+            return
+        res = suite.find('results')
+        if res is not None:
+            for x in res.findall('test-suite'):
+                walk(x, names)
+    for x in XML.parse(path).getroot().findall('test-suite'):
+        walk(x, [])
+    return ret
+
+def merge_suite(dst, src):
+    """
+    Merge the test suite *src* (shard of the same suite) into *dst*
+    """
+    merge_counters(dst, src)
+    sres = src.find('results')
+    if sres is None:
+        return
+    dres = dst.find('results')
+    if dres is None:
+        dst.append(sres)
+        return
+    index = dict((x.get('name'), x) for x in dres.findall('test-suite'))
+    for x in list(sres):
+        y = None
+        if x.tag == 'test-suite':
+            y = index.get(x.get('name'))
+        if y is not None:
+            merge_suite(y, x)
+        else:
+            dres.append(x)
+            if x.tag == 'test-suite':
+                index[x.get('name')] = x
+
+def merge_counters(dst, src):
+    dst.set('time', '%.3f' % (float(dst.get('time') or 0) + float(src.get('time') or 0)))
+    dst.set('asserts', str(int(dst.get('asserts') or 0) + int(src.get('asserts') or 0)))
+    if RESULT_RANK.get(src.get('result'), 0) > RESULT_RANK.get(dst.get('result'), 0):
+        dst.set('result', src.get('result'))
+    if src.get('success') == 'False':
+        dst.set('success', 'False')
+    if src.get('executed') == 'True':
+        dst.set('executed', 'True')
+
+def merge_results(files, path):
+    """
+    Merge NUnit result files in one report, the shards of an assembly are merged together
+
+    :return: the counters of the report (total, failures, errors...)
+    """
+    first = None
+    totals = dict((k, 0) for k in RESULT_COUNTS)
+    suites = []
+    index = {}
+    for f in files:
+        root = XML.parse(f).getroot()
+        if first is None:
+            first = root
+        for k in RESULT_COUNTS:
+            totals[k] += int(root.get(k) or 0)
+        lst = root.findall('test-suite')
+        if len(lst) == 1 and lst[0].get('type') == 'Test Project':
+            # merged report, see nunit_report
+            lst = lst[0].find('results').findall('test-suite')
+        for x in lst:
+            y = index.get(x.get('name'))
+            if y is None:
+                index[x.get('name')] = x
+                suites.append(x)
+            else:
+                merge_suite(y, x)
+
+    out = XML.Element('test-results', name='waf nunit')
+    for k in RESULT_COUNTS:
+        out.set(k, str(totals[k]))
+    for k in ('date', 'time'):
+        if first is not None and first.get(k):
+            out.set(k, first.get(k))
+    if first is not None:
+        for k in ('environment', 'culture-info'):
+            x = first.find(k)
+            if x is not None:
+                out.append(x)
+
+    project = XML.SubElement(out, 'test-suite', {'type': 'Test Project', 'name': 'waf nunit', 'executed': 'True',
+        'result': 'Success', 'success': 'True', 'time': '0', 'asserts': '0'})
+    results = XML.SubElement(project, 'results')
+    for x in suites:
+        merge_counters(project, x)
+        results.append(x)
+
+    XML.ElementTree(out).write(path, encoding='utf-8')
+    return totals
+
+def nunit_report(bld):
+    """
+    Merge the results of the nunit tasks, keep the durations of the fixtures for the
+    next runs and fail if a test failed
+    """
+    results = getattr(bld, 'nunit_results', [])
+    results.sort(key=lambda x: x['xml'])
+
+    times = load_times(bld)
+    ran = {}
+    for x in results:
+        if x.get('cached'):
+            continue
+        entry = ran.setdefault(x['assembly'], {'key': x['key'], 'fixtures': {}, 'test_key': x['test_key'], 'xml': []})
+        entry['xml'].append(x['xml'])
+        try:
+            entry['fixtures'].update(read_fixtures(x['xml']))
+        except (OSError, IOError, XML.ParseError):
+            Logs.warn('nunit: could not read %r' % x['xml'])
+
+    # keep the results of the assemblies which passed, they are not run again with the same key
+    for (k, entry) in ran.items():
+        test_key = entry.pop('test_key')
+        try:
+            counts = merge_results(entry.pop('xml'), passed_xml(bld, k))
+        except (OSError, IOError, XML.ParseError):
+            continue
+        if not (counts['failures'] or counts['errors']):
+            entry['passed'] = test_key
+    times.update(ran)
+    try:
+        Utils.writef(os.path.join(bld.variant_dir, NUNIT_TIMES), json.dumps(times, indent=1, sort_keys=True))
+    except (OSError, IOError):
+        Logs.warn('nunit: could not store the durations of the fixtures')
+
+    path = bld.bldnode.make_node([NUNIT_DIR, 'TestResult.xml']).abspath()
+    try:
+        totals = merge_results([x['xml'] for x in results], path)
+    except (OSError, IOError, XML.ParseError) as e:
+        bld.fatal('nunit: could not merge the test results: %s' % e)
+
+    cached = [x['assembly'] for x in results if x.get('cached')]
+    if cached:
+        Logs.info('nunit: %d assemblies passed with the same assemblies, not run again: %s' % (len(cached), ' '.join(cached)))
+
+    msg = 'nunit: %d tests, %d failures, %d errors, %d not run -> %s' % (totals['total'],
+        totals['failures'], totals['errors'], totals['not-run'], path)
+    if totals['failures'] or totals['errors']:
+        bld.fatal(msg)
+    Logs.pprint('GREEN', msg)
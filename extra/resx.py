@@ -2,39 +2,234 @@
 # encoding: utf-8
 # Steve Beaulac, 2013 (SjB)
 
-import os
-from waflib import Task
-from waflib.TaskGen import extension
+"""
+Compile the .resx files of a C# task generator into .resources files embedded in the assembly::
+
+	def build(bld):
+		bld(features='cs', source='main.cs Strings.resx', target='foo.exe', resgen_batch=50)
+
+The .resx files are compiled by batches of *resgen_batch* files (RESGEN_BATCH by default)
+with one resgen process per batch, and only the files that changed are compiled again.
+
+The .resx files containing only strings are compiled in waf's own threads without
+resgen (see :py:func:`compile_resx`), set RESGEN_INPROCESS to False to always use resgen.
+"""
+
+import os, struct
+import xml.etree.ElementTree as XML
+from waflib import Logs, Options, Task, Utils
+from waflib.TaskGen import extension, feature, after, before
+
+try:
+	from cs import profile_task
+except ImportError:
+	def profile_task(cls):
+		return cls
 
 def options(opt):
 	opt.add_option('--with-resgen-binary', type='string', dest='resgenbinary', help='localtion of the resgen binary')
 
 def configure(conf):
-	resgen = getattr(Options.options, 'resgenbinary', 'resgen')
-	conf.find_program([resgen], var='RESGEN')
+	resgen = getattr(Options.options, 'resgenbinary', None) or 'resgen'
+	conf.env.RESGEN_INPROCESS = True
+	# resgen is only needed for the resources which are not strings
+	conf.find_program([resgen], var='RESGEN', mandatory=False)
 	conf.env.RESGENFLAGS = '/useSourcePath'
+	conf.env.RESGEN_BATCH = 100
 
 @extension('.resx')
 def resx_file(self, node):
 	"""
-	Bind the .resx extension to a resgen task
+	Bind the .resx extension to a resgen task, see :py:func:`apply_resx`
 	"""
+	try:
+		self.resx_nodes.append(node)
+	except AttributeError:
+		self.resx_nodes = [node]
+
+@feature('cs')
+@after('apply_cs')
+@before('use_cs')
+def apply_resx(self):
+	"""
+	Create the resgen tasks, one for every *resgen_batch* .resx files
+	"""
+	nodes = getattr(self, 'resx_nodes', [])
+	if not nodes:
+		return
+
 	if not getattr(self, 'cs_task', None):
 		self.bld.fatal('resx_file has no link task for use %r' % self)
 
 	# Given assembly 'Foo' and file 'Sub/Dir/File.resx', create 'Foo.Sub.Dir.File.resources'
-	assembly = os.path.splitext(self.gen)[0]
-	res = os.path.splitext(node.path_from(self.path))[0].replace('/', '.')
-	out = self.path.find_or_declare(assembly + '.' + res + '.resources')
+	assembly = os.path.splitext(getattr(self, 'gen', self.target))[0]
+	size = int(getattr(self, 'resgen_batch', self.env.RESGEN_BATCH or 100))
 
-	tsk = self.create_task('resgen', node, out)
+	for i in range(0, len(nodes), size):
+		outs = []
+		for node in nodes[i:i + size]:
+			res = os.path.splitext(node.path_from(self.path))[0].replace('/', '.')
+			outs.append(self.path.find_or_declare(assembly + '.' + res + '.resources'))
 
-	self.cs_task.dep_nodes.extend(tsk.outputs) # dependency
-	self.env.append_value('RESOURCES', tsk.outputs[0].bldpath())
+		tsk = self.create_task('resgen', nodes[i:i + size], outs)
+		self.cs_task.dep_nodes.extend(tsk.outputs) # dependency
+		self.env.append_value('RESOURCES', [x.bldpath() for x in tsk.outputs])
 
+@profile_task
 class resgen(Task.Task):
 	"""
-	Compile C# resource files
+	Compile C# resource files, all the files of the task in one resgen process
+	(resgen /compile a.resx,a.resources b.resx,b.resources ...). When the task runs
+	again, only the files whose input changed are compiled.
 	"""
 	color   = 'YELLOW'
-	run_str = '${RESGEN} ${RESGENFLAGS} ${SRC} ${TGT}'
+	vars    = ['RESGEN', 'RESGENFLAGS', 'RESGEN_INPROCESS']
+
+	def run(self):
+		self.compiled = self.stale_pairs()
+
+		lst = []
+		for (x, y) in self.compiled:
+			if not (self.env.RESGEN_INPROCESS and compile_resx(x.abspath(), y.abspath())):
+				lst.append((x, y))
+		if not lst:
+			return 0
+
+		if not self.env.RESGEN:
+			Logs.error('resgen is required for %s' % ' '.join(x.abspath() for (x, y) in lst))
+			return 1
+		cmd = Utils.to_list(self.env.RESGEN) + Utils.to_list(self.env.RESGENFLAGS) + ['/compile']
+		cmd.extend('%s,%s' % (x.abspath(), y.abspath()) for (x, y) in lst)
+		return self.exec_command(cmd)
+
+	def pair_sig(self, node):
+		m = Utils.md5()
+		m.update(node.get_bld_sig())
+		m.update(self.generator.bld.hash_env_vars(self.env, self.vars))
+		return m.digest()
+
+	def stale_pairs(self):
+		"""
+		Return the (input, output) pairs to compile: the output is missing, or the
+		input or the resgen flags changed since it was compiled
+		"""
+		sigs = self.generator.bld.task_sigs
+		lst = []
+		for (x, y) in zip(self.inputs, self.outputs):
+			if sigs.get(('resgen', y.abspath())) != self.pair_sig(x) or not os.path.isfile(y.abspath()):
+				lst.append((x, y))
+		return lst
+
+	def post_run(self):
+		Task.Task.post_run(self)
+		sigs = self.generator.bld.task_sigs
+		for (x, y) in self.compiled:
+			sigs[('resgen', y.abspath())] = self.pair_sig(x)
+
+# Binary .resources format, as written by System.Resources.ResourceWriter
+RESOURCES_MAGIC = 0xBEEFCACE
+RESOURCES_READER = 'System.Resources.ResourceReader, mscorlib, Version=4.0.0.0, Culture=neutral, PublicKeyToken=b77a5c561934e089'
+RESOURCES_SET = 'System.Resources.RuntimeResourceSet'
+TYPE_STRING = 1
+
+class NotAString(Exception):
+	pass
+
+def read_resx_strings(path):
+	"""
+	Stream the <data> elements of a .resx file
+
+	:return: a list of (name, value)
+	:raise NotAString: if a resource has a type or a mime type other than a string
+	"""
+	lst = []
+	for (event, elem) in XML.iterparse(path):
+		if elem.tag == 'data':
+			typ = elem.get('type')
+			if elem.get('mimetype') or (typ and not typ.split(',')[0].strip() == 'System.String'):
+				raise NotAString(elem.get('name'))
+			value = elem.find('value')
+			lst.append((elem.get('name'), value is not None and value.text or ''))
+			elem.clear()
+		elif elem.tag in ('resheader', 'metadata', 'assembly'):
+			elem.clear()
+	return lst
+
+def resource_hash(name):
+	"""
+	System.Resources.FastResourceComparer.HashFunction, on the UTF-16 code units of *name*
+	"""
+	data = name.encode('utf-16-le')
+	h = 5381
+	for c in struct.unpack('<%dH' % (len(data) // 2), data):
+		h = (((h << 5) + h) ^ c) & 0xFFFFFFFF
+	return struct.unpack('<i', struct.pack('<I', h))[0]
+
+def write_7bit_int(value):
+	ret = bytearray()
+	while value >= 0x80:
+		ret.append((value & 0x7F) | 0x80)
+		value >>= 7
+	ret.append(value)
+	return bytes(ret)
+
+def write_string(value, encoding):
+	data = value.encode(encoding)
+	return write_7bit_int(len(data)) + data
+
+def write_resources(resources):
+	"""
+	Return the content of a .resources file holding the given strings
+
+	:param resources: list of (name, value)
+	"""
+	names = []
+	data = []
+	name_pos = 0
+	data_pos = 0
+	entries = []
+	for (name, value) in resources:
+		entries.append((resource_hash(name), name_pos))
+		n = write_string(name, 'utf-16-le') + struct.pack('<i', data_pos)
+		d = write_7bit_int(TYPE_STRING) + write_string(value, 'utf-8')
+		names.append(n)
+		data.append(d)
+		name_pos += len(n)
+		data_pos += len(d)
+	entries.sort()
+
+	header = write_string(RESOURCES_READER, 'utf-8') + write_string(RESOURCES_SET, 'utf-8')
+	out = [struct.pack('<Ii', RESOURCES_MAGIC, 1), struct.pack('<i', len(header)), header]
+	out.append(struct.pack('<iii', 2, len(resources), 0))
+
+	size = sum(len(x) for x in out)
+	if size & 7:
+		out.append(b'PADPADPA'[:8 - (size & 7)])
+	out.append(struct.pack('<%di' % len(entries), *[x[0] for x in entries]))
+	out.append(struct.pack('<%di' % len(entries), *[x[1] for x in entries]))
+
+	size = sum(len(x) for x in out)
+	out.append(struct.pack('<i', size + 4 + name_pos))
+	out.extend(names)
+	out.extend(data)
+	return b''.join(out)
+
+def compile_resx(src, tgt):
+	"""
+	Compile a .resx file containing only strings into a .resources file
+
+	:return: False if the file holds other resources, resgen must be used then
+	"""
+	try:
+		resources = read_resx_strings(src)
+	except NotAString:
+		return False
+
+	# duplicate names: keep the last value at the first position
+	dct = dict(resources)
+	lst = []
+	for (k, v) in resources:
+		if k in dct:
+			lst.append((k, dct.pop(k)))
+	Utils.writef(tgt, write_resources(lst), 'wb')
+	return True
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# tests of extra/cs.py: the waf of the repository builds small projects with a fake compiler
+#
+#   $ python -m unittest discover tests
+#
+# waf 1.7 needs python 2, WAF_PYTHON may name the interpreter to run it with
+
+import os, shutil, subprocess, sys, tempfile, unittest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PYTHON = os.environ.get('WAF_PYTHON', sys.executable)
+
+# the assembly holds the contents of the referenced assemblies and of the sources, in the order of the command line
+FAKE_MCS = '''#!%s
+import os, sys
+out = None
+data = []
+for x in sys.argv[1:]:
+	if x.startswith('/out:'):
+		out = x[5:]
+		continue
+	for y in ('-r:', '/r:', '/reference:'):
+		if x.startswith(y):
+			x = x[len(y):]
+			break
+	if os.path.isfile(x):
+		data.append(open(x).read())
+open(out, 'w').write(''.join(data))
+''' % PYTHON
+
+def can_run_waf():
+	# waf unpacks itself next to the script, not in the repository
+	tmp = tempfile.mkdtemp()
+	try:
+		shutil.copy(os.path.join(TOP, 'waf'), tmp)
+		try:
+			return subprocess.call([PYTHON, 'waf', '--version'], cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) == 0
+		except OSError:
+			return False
+	finally:
+		shutil.rmtree(tmp)
+
+class Project(object):
+	"""
+	Temporary waf project using the tools of the repository and a fake mcs
+	"""
+	def __init__(self, root, name, wscript):
+		self.path = os.path.join(root, name)
+		bin = os.path.join(root, 'bin')
+		if not os.path.isdir(bin):
+			os.makedirs(bin)
+			mcs = os.path.join(bin, 'mcs')
+			self.write(mcs, FAKE_MCS)
+			os.chmod(mcs, 0o755)
+		self.env = dict(os.environ)
+		self.env['PATH'] = bin + os.pathsep + self.env.get('PATH', '')
+		self.write('wscript', wscript % {'tooldir': os.path.join(TOP, 'extra')})
+		shutil.copy(os.path.join(TOP, 'waf'), self.path)
+
+	def write(self, name, data):
+		path = os.path.join(self.path, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		f = open(path, 'w')
+		try:
+			f.write(data)
+		finally:
+			f.close()
+
+	def read(self, name):
+		f = open(os.path.join(self.path, name))
+		try:
+			return f.read()
+		finally:
+			f.close()
+
+	def waf(self, *k):
+		proc = subprocess.Popen([PYTHON, 'waf'] + list(k), cwd=self.path, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		out = proc.communicate()[0].decode('utf-8', 'replace')
+		if proc.returncode:
+			raise AssertionError('waf %s failed:\n%s' % (' '.join(k), out))
+		return out
+
+CACHE_WSCRIPT = '''
+top = '.'
+out = 'build'
+def options(opt):
+	opt.load('cs', tooldir=%(tooldir)r)
+def configure(conf):
+	conf.load('cs', tooldir=%(tooldir)r)
+	conf.check_assembly('Ext', path_list=['libs'])
+def build(bld):
+	bld(features='cs', source='main.cs', target='app.exe', use='Ext')
+'''
+
+@unittest.skipUnless(can_run_waf(), 'waf cannot run with %s' % PYTHON)
+class CacheTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.cache = os.path.join(self.root, 'cache')
+
+	def tearDown(self):
+		shutil.rmtree(self.root)
+
+	def project(self, name, ext):
+		prj = Project(self.root, name, CACHE_WSCRIPT)
+		prj.write('main.cs', 'main;')
+		prj.write('libs/Ext.dll', ext)
+		prj.waf('configure', '--cs-cache=%s' % self.cache)
+		return prj
+
+	def test_foreign_assembly_in_key(self):
+		a = self.project('a', 'ext1;')
+		a.waf('build')
+		self.assertEqual(a.read('build/app.exe'), 'ext1;main;')
+
+		# same sources and paths, another assembly: no entry of the cache matches
+		b = self.project('b', 'ext2;')
+		b.waf('build')
+		self.assertEqual(b.read('build/app.exe'), 'ext2;main;')
+
+		c = self.project('c', 'ext1;')
+		self.assertTrue(c.waf('build', '-v', '--zones=cs').find('cache hits: 1') > -1)
+		self.assertEqual(c.read('build/app.exe'), 'ext1;main;')
+
+	def test_foreign_assembly_changed(self):
+		a = self.project('a', 'ext1;')
+		a.waf('build')
+		a.write('libs/Ext.dll', 'ext2;')
+		a.waf('build')
+		self.assertEqual(a.read('build/app.exe'), 'ext2;main;')
+
+MODULES_WSCRIPT = '''
+top = '.'
+out = 'build'
+def options(opt):
+	opt.load('cs csproj', tooldir=%(tooldir)r)
+def configure(conf):
+	conf.load('cs csproj', tooldir=%(tooldir)r)
+def build(bld):
+	bld(features='cs', source='a/a.cs', target='A.dll', name='A',
+		cs_modules=[{'name': 'A.B', 'source': bld.path.ant_glob('b/*.cs')}])
+'''
+
+@unittest.skipUnless(can_run_waf(), 'waf cannot run with %s' % PYTHON)
+class CsprojTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.root)
+
+	def test_module_sources(self):
+		prj = Project(self.root, 'p', MODULES_WSCRIPT)
+		prj.write('a/a.cs', 'a;')
+		prj.write('b/b.cs', 'b;')
+		prj.waf('configure')
+		prj.waf('msbuild')
+		data = prj.read('A.csproj')
+		self.assertTrue(data.find('a/a.cs') > -1)
+		self.assertTrue(data.find('b/b.cs') > -1)
+
+		# a new source of the module writes the file again
+		prj.write('b/c.cs', 'c;')
+		prj.waf('msbuild')
+		self.assertTrue(prj.read('A.csproj').find('b/c.cs') > -1)
+
+if __name__ == '__main__':
+	unittest.main()